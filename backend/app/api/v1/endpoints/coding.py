@@ -1,7 +1,9 @@
+import asyncio
+import logging
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, Request, status, HTTPException
 from sqlalchemy.orm import Session
 from sqlalchemy import text 
-from backend.app.dependencies import get_db
+from backend.app.dependencies import get_db, SessionLocal
 from backend.app.schemas.room import RoomCreate, AutocompleteRequest, AutocompleteResponse
 from backend.app.crud import room_crud
 from backend.app.core.ws_manager import manager
@@ -16,9 +18,17 @@ common_responses = {
 
 router = APIRouter(responses=common_responses)
 
+# Bound once instead of looked up on every guarded log call
+_log_enabled = logger.isEnabledFor
+
+# Mocked autocomplete suggestions
+_DEF = AutocompleteResponse(suggestion="function_name():\n    pass")
+_CLASS = AutocompleteResponse(suggestion="ClassName:\n    pass")
+_DEFAULT = AutocompleteResponse(suggestion=" # (Mock AI) Continue code...")
+
 
 @router.get("/liveness")
-def get_liveness():
+async def get_liveness():
     """
     Returns application status. Used to check if the process is running.
     """
@@ -36,7 +46,7 @@ def get_health_check(db: Session = Depends(get_db)):
         logger.info("Health check passed: Database connection successful.")
         return {"status": "ok", "database": "accessible"}
     except Exception as e:
-        logger.error(f"Health check failed: Database connection error. {e}")
+        logger.error("Health check failed: Database connection error. %s", e)
         # Use HTTP 503 Service Unavailable status code
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -49,71 +59,95 @@ def rest_create_room(request: Request, db: Session = Depends(get_db)):
     POST /rooms: Creates a new room. 
     Also logs incoming request headers.
     """
-    # 1. Log Request Headers
-    relevant_headers = {
-        'x-username': request.headers.get('x-username', 'N/A'),
-        'x-usermail': request.headers.get('x-usermail', 'N/A'),
-    }
-    logger.info(f"Request to POST /rooms received. Headers logged: {relevant_headers}")
+    # 1. Log Request Headers (skipped entirely when INFO is disabled)
+    if _log_enabled(logging.INFO):
+        headers = request.headers
+        relevant_headers = {
+            'x-username': headers.get('x-username', 'N/A'),
+            'x-usermail': headers.get('x-usermail', 'N/A'),
+        }
+        logger.info("Request to POST /rooms received. Headers logged: %s", relevant_headers)
     
     # 2. Process Request
     room_id = room_crud.create_room(db)
-    logger.info(f"New room created with ID: {room_id}")
+    logger.info("New room created with ID: %s", room_id)
     
     return {"roomId": room_id}
 
 @router.post("/autocomplete", response_model=AutocompleteResponse)
-def rest_get_autocomplete(payload: AutocompleteRequest):
+async def rest_get_autocomplete(payload: AutocompleteRequest):
     """POST /autocomplete: Provides a mocked suggestion."""
     
-    logger.debug(f"Autocomplete requested for language: {payload.language}")
+    logger.debug("Autocomplete requested for language: %s", payload.language)
     
-    # Mock logic based on keywords
-    suggestion = ""
-    if payload.code.endswith("def "):
-         suggestion = "function_name():\n    pass"
-    elif payload.code.endswith("class "):
-         suggestion = "ClassName:\n    pass"
-    else:
-         suggestion = " # (Mock AI) Continue code..."
+    # Mock logic based on keywords; the responses are static, so they are built once
+    code = payload.code
+    if code.endswith("def "):
+        return _DEF
+    if code.endswith("class "):
+        return _CLASS
+    return _DEFAULT
 
-    return {"suggestion": suggestion}
+def _find_room(room_id: str):
+    """
+    Looks the room up with a session of its own, closed right after the query.
+    A socket lives for minutes, so it must not hold a pooled connection that long.
+    """
+    db = SessionLocal()
+    try:
+        return room_crud.get_room_by_id(db, room_id)
+    finally:
+        db.close()
 
 @router.websocket("/ws/{room_id}")
-async def ws_coding(websocket: WebSocket, room_id: str, db: Session = Depends(get_db)):
+async def ws_coding(websocket: WebSocket, room_id: str):
     """/ws/{room_id}: Handles real-time code updates."""
     
     # 1. Check if room exists before connecting (THE FIX)
-    room = room_crud.get_room_by_id(db, room_id)
-    
-    if not room:
-         # Close with code 1008 Policy Violation if room is invalid/missing
-         await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Room does not exist.")
-         logger.warning(f"WebSocket rejected connection for unknown room ID: {room_id}")
-         return
+    # Rooms seen recently are served from memory, sparing reconnecting clients a query
+    initial_code = manager.cached_document(room_id)
+
+    if initial_code is None:
+        # The query is blocking, so run it in a worker thread to keep other sockets responsive
+        room = await asyncio.to_thread(_find_room, room_id)
+
+        if not room:
+             # Close with code 1008 Policy Violation if room is invalid/missing
+             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Room does not exist.")
+             logger.warning("WebSocket rejected connection for unknown room ID: %s", room_id)
+             return
+
+        initial_code = room.code_content or ""
 
 
     # 2. Connect and Send initial state
     await manager.connect(websocket, room_id)
+    manager.remember_room(room_id)
     
-    # Use the retrieved room object's code content
-    initial_code = room.code_content 
+    # Peers that are already editing hold a newer document than the database row
+    manager.open_document(room_id, initial_code)
     
-    if initial_code:
-        # Send existing code to the newly connected client
-        await websocket.send_text(initial_code)
-        logger.info(f"WebSocket client connected to room {room_id}. Sent initial state.")
+    # Hand the document to the newly connected client; a newer peer update supersedes it.
+    # The frame is encoded once per change, not once per connection
+    manager.send_document(websocket, room_id)
+    logger.info("WebSocket client connected to room %s. Sent initial state.", room_id)
 
     try:
         while True:
-            # Data received is the full content of the editor
+            # Data received is a patch frame, or the full content of the editor
             data = await websocket.receive_text()
-          
-            room_crud.update_room_code(db, room_id, data)
+            # Per-message logging is skipped entirely unless DEBUG is enabled
+            if _log_enabled(logging.DEBUG):
+                logger.debug("Received %d characters for room %s.", len(data), room_id)
 
-            # 4. Broadcast to all others in the room
-            await manager.broadcast(data, room_id, websocket)
+            # 3. Apply it to the room's document and broadcast to all others in the room
+            await manager.receive_frame(data, room_id, websocket)
 
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Runs for unexpected errors too, so the socket never lingers in the manager
         manager.disconnect(websocket, room_id)
-        logger.info(f"WebSocket client disconnected from room {room_id}.")
\ No newline at end of file
+        # Persist the last edit right away instead of waiting for the next flush
+        await manager.flush([room_id])
+        logger.info("WebSocket client disconnected from room %s.", room_id)
\ No newline at end of file
@@ -1,6 +1,7 @@
 import json
 import os
-from typing import  Any, Dict
+from functools import lru_cache
+from typing import  Any, Dict, Optional
 
 from pydantic_settings import BaseSettings
 from pydantic import model_validator
@@ -11,15 +12,22 @@ CONFIG_FILE_PATH = "config.json"
 ENVIRONMENT = os.environ.get("ENV_STATE", "PRODUCTION")
 
 
+@lru_cache(maxsize=1)
+def _read_config_file() -> Dict[str, Any]:
+    """Parses the JSON config file once; later calls reuse the parsed content."""
+    with open(CONFIG_FILE_PATH, 'r') as f:
+        return json.load(f)
+
+
 def _load_db_config_url() -> str:
     """Reads database credentials from the JSON file and constructs the connection URL."""
+    # Check if running inside a container (e.g., Docker Compose); the file is not needed then
+    env_url = os.environ.get("SQLALCHEMY_DATABASE_URL")
+    if env_url:
+        return env_url
+
     try:
-        # Check if running inside a container (e.g., Docker Compose)
-        if os.environ.get("SQLALCHEMY_DATABASE_URL"):
-             return os.environ["SQLALCHEMY_DATABASE_URL"]
-             
-        with open(CONFIG_FILE_PATH, 'r') as f:
-            config = json.load(f)
+        config = _read_config_file()
         
         # 1. Retrieve the environment block (e.g., "PRODUCTION")
         env_config = config.get(ENVIRONMENT, {}) 
@@ -55,6 +63,9 @@ class Settings(BaseSettings):
     # Define SQLALCHEMY_DATABASE_URL as Optional, but with a required validator
     SQLALCHEMY_DATABASE_URL: str
 
+    # Redis used to relay room messages between workers; unset when running a single worker
+    REDIS_URL: Optional[str] = None
+
     @model_validator(mode='before')
     @classmethod
     def set_db_url(cls, values: Dict[str, Any]) -> Dict[str, Any]:
@@ -66,4 +77,9 @@ class Settings(BaseSettings):
              values['SQLALCHEMY_DATABASE_URL'] = _load_db_config_url()
         return values
 
-settings = Settings()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Builds the settings once per process; later calls return the same instance."""
+    return Settings()
+
+settings = get_settings()
\ No newline at end of file
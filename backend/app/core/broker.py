@@ -0,0 +1,156 @@
+import asyncio
+import json
+import time
+import uuid
+from typing import Dict, Optional, Protocol, Tuple
+from redis import asyncio as redis_asyncio
+from backend.app.core.logger import logger
+
+# Identifies this worker process, so it can skip its own messages when Redis echoes them back
+WORKER_ID = uuid.uuid4().hex
+
+# Pause before a failed room listener subscribes again
+RECONNECT_DELAY_SECONDS = 1.0
+# How long a worker that just (re)subscribed treats its copy as behind and doesn't hand it out
+CATCH_UP_SECONDS = 1.0
+
+
+class RoomHandler(Protocol):
+    """Receives what other workers publish for a room."""
+
+    async def receive_frame(self, data: str, room_id: str):
+        """A frame another worker received from one of its clients."""
+
+    async def receive_document(self, code: str, room_id: str):
+        """The complete document picked for the room, replacing this worker's copy."""
+
+    def current_document(self, room_id: str) -> Optional[str]:
+        """This worker's copy of the document, or None if it has none."""
+
+
+class RoomBroker:
+    """
+    Relays client frames between uvicorn workers over Redis pub/sub.
+    Each worker subscribes to room:{room_id} while it has clients in that room.
+    Whenever a worker (re)subscribes, it asks the others for their copy of the document,
+    covering edits that were not flushed to the database yet or published while it wasn't listening.
+
+    Each document request starts a round in which every worker answers with its copy.
+    Copies can differ, so all workers adopt the one of the lowest worker ID taking part;
+    its copy wins no matter in which order the answers arrive.
+    """
+
+    def __init__(self, url: str):
+        self.redis = redis_asyncio.from_url(url)
+        self.worker_id = WORKER_ID
+        # Key: room_id, Value: Task listening to the room's channel
+        self.listeners: Dict[str, asyncio.Task] = {}
+        # Key: room_id, Value: Latest document request round and the worker ID whose copy is held
+        # (None while catching up, when any answer is better than the local copy)
+        self.rounds: Dict[str, Tuple[str, Optional[str]]] = {}
+        # Key: room_id, Value: time.monotonic() until which this worker is catching up
+        self.catching_up: Dict[str, float] = {}
+
+    async def publish(self, room_id: str, data: str):
+        """Sends a frame received from a local client to the other workers."""
+        await self._publish(room_id, {"data": data})
+
+    async def publish_document(self, room_id: str, code: str, round_id: str):
+        """Sends this worker's complete document, answering the document request round_id."""
+        await self._publish(room_id, {"code": code, "round": round_id})
+
+    async def request_document(self, room_id: str, code: Optional[str] = None):
+        """
+        Asks the other workers for their complete document.
+        code is this worker's copy when it competes with theirs, e.g. after a relayed patch
+        didn't apply; None when it is behind, e.g. after subscribing.
+        """
+        round_id = uuid.uuid4().hex
+        message = {"sync": True, "round": round_id}
+        if code is None:
+            self.rounds[room_id] = (round_id, None)
+            self.catching_up[room_id] = time.monotonic() + CATCH_UP_SECONDS
+        else:
+            self.rounds[room_id] = (round_id, self.worker_id)
+            message["code"] = code
+        await self._publish(room_id, message)
+
+    def subscribe(self, room_id: str, handler: RoomHandler):
+        """Starts relaying messages of other workers for the room, if not already running."""
+        if room_id not in self.listeners:
+            self.listeners[room_id] = asyncio.create_task(self._listen(room_id, handler))
+
+    def unsubscribe(self, room_id: str):
+        listener = self.listeners.pop(room_id, None)
+        if listener:
+            listener.cancel()
+        self.rounds.pop(room_id, None)
+        self.catching_up.pop(room_id, None)
+
+    async def close(self):
+        for room_id in list(self.listeners):
+            self.unsubscribe(room_id)
+        await self.redis.aclose()
+
+    async def _publish(self, room_id: str, message: Dict[str, object]):
+        payload = json.dumps({"origin": self.worker_id, **message})
+        await self.redis.publish(self._channel(room_id), payload)
+
+    async def _listen(self, room_id: str, handler: RoomHandler):
+        """Relays the room's channel until cancelled, subscribing again whenever Redis fails."""
+        channel = self._channel(room_id)
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(channel)
+                # Catch up on edits this worker has not seen
+                await self.request_document(room_id)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    payload = json.loads(message["data"])
+                    if payload["origin"] != self.worker_id:
+                        await self._dispatch(room_id, handler, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Redis listener for room %s failed, subscribing again: %s", room_id, e)
+            finally:
+                await pubsub.aclose()
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+    async def _dispatch(self, room_id: str, handler: RoomHandler, payload: Dict[str, object]):
+        origin = payload["origin"]
+        if "data" in payload:
+            await handler.receive_frame(payload["data"], room_id)
+        elif payload.get("sync"):
+            if self.catching_up.get(room_id, 0) > time.monotonic():
+                # A copy that is behind must not win a round
+                return
+            # Join the round with this worker's copy, adopting the requester's if it ranks first
+            self.rounds[room_id] = (payload["round"], self.worker_id)
+            if "code" in payload and self._adopt(room_id, payload["round"], origin):
+                await handler.receive_document(payload["code"], room_id)
+            code = handler.current_document(room_id)
+            if code is not None:
+                await self.publish_document(room_id, code, payload["round"])
+        elif "code" in payload:
+            if self._adopt(room_id, payload.get("round"), origin):
+                await handler.receive_document(payload["code"], room_id)
+
+    def _adopt(self, room_id: str, round_id: Optional[str], origin: str) -> bool:
+        """Whether a copy published in a round by origin replaces the one held for the room."""
+        current = self.rounds.get(room_id)
+        if current is None or current[0] != round_id:
+            # Answer to an older round
+            return False
+        held = current[1]
+        if held is not None and origin >= held:
+            return False
+        self.rounds[room_id] = (round_id, origin)
+        self.catching_up.pop(room_id, None)
+        return True
+
+    @staticmethod
+    def _channel(room_id: str) -> str:
+        return f"room:{room_id}"
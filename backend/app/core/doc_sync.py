@@ -0,0 +1,83 @@
+import json
+import zlib
+from typing import Optional, Tuple, Union
+from diff_match_patch import diff_match_patch
+
+# Frames exchanged over /ws/{room_id}:
+#   {"base": <hash>, "patch": "<diff-match-patch text>"}
+#                                          an edit relative to the document whose
+#                                          document_hash() is base
+#   {"code": "<full document>"}            the complete document (initial state / resync)
+# Server frames of at least COMPRESSION_MIN_SIZE bytes are sent as binary messages
+# holding the zlib-compressed JSON; smaller ones are sent as plain text.
+COMPRESSION_MIN_SIZE = 512
+COMPRESSION_LEVEL = 1
+
+_dmp = diff_match_patch()
+# Applies patches made against an older document, i.e. with a concurrent edit in between.
+# Their context must still be there verbatim, only its position may have moved: a threshold
+# below 1 / Match_MaxBits allows no error, the huge distance any shift.
+_strict_dmp = diff_match_patch()
+_strict_dmp.Match_Threshold = 0.5 / _strict_dmp.Match_MaxBits
+_strict_dmp.Match_Distance = 10 ** 9
+_strict_dmp.Patch_DeleteThreshold = 0.0
+
+
+def code_frame(code: str) -> str:
+    """Builds a frame carrying the complete document."""
+    return json.dumps({"code": code})
+
+
+def document_hash(code: str) -> int:
+    """
+    CRC-32 of the UTF-8 encoded document, the base a patch was made against.
+    The frontend computes the same value before sending a patch.
+    """
+    return zlib.crc32(code.encode())
+
+
+def encode_frame(frame: str) -> Union[str, bytes]:
+    """
+    Prepares a server frame for the wire. Large frames are compressed here once,
+    so a broadcast doesn't pay for one compression per receiver.
+    """
+    data = frame.encode()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return frame
+    return zlib.compress(data, COMPRESSION_LEVEL)
+
+
+def parse_patch(data: str) -> Optional[Tuple[str, Optional[int]]]:
+    """
+    Returns the patch text and base hash of a patch frame; base is None if the frame has none.
+    Returns None for anything else, which is treated as the full editor buffer.
+    """
+    if not data.startswith("{"):
+        return None
+    try:
+        frame = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(frame, dict) or not isinstance(frame.get("patch"), str):
+        return None
+    base = frame.get("base")
+    if not isinstance(base, int) or isinstance(base, bool):
+        base = None
+    return frame["patch"], base
+
+
+def apply_patch(document: str, patch_text: str, strict: bool = False) -> Optional[str]:
+    """
+    Applies a patch to the document. Returns None if any hunk does not apply.
+    strict requires the context of every hunk to match exactly, for patches made against
+    another version of the document, which fuzzy matching could place on the wrong text.
+    """
+    dmp = _strict_dmp if strict else _dmp
+    try:
+        patches = dmp.patch_fromText(patch_text)
+    except ValueError:
+        return None
+    new_document, results = dmp.patch_apply(patches, document)
+    if not all(results):
+        return None
+    return new_document
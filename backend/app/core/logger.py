@@ -1,5 +1,8 @@
+import atexit
 import logging
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
 
 LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(pathname)s:%(lineno)d] - %(message)s"
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -20,10 +23,18 @@ def setup_logger(name: str = "app", level=logging.INFO):
     handler = logging.StreamHandler(sys.stdout)
     formatter = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
     handler.setFormatter(formatter)
+
+    # Records are only queued by the caller; a background thread writes them to stdout,
+    # so a slow console never blocks the event loop
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    queue_handler.listener = QueueListener(queue_handler.queue, handler)
+    queue_handler.listener.start()
+    # Write out whatever is still queued when the process exits
+    atexit.register(queue_handler.listener.stop)
     
     # Add handler if it doesn't exist
     if not logger.handlers:
-        logger.addHandler(handler)
+        logger.addHandler(queue_handler)
     
     return logger
 
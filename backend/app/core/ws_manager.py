@@ -1,28 +1,300 @@
-from typing import List, Dict
-from fastapi import WebSocket
+import asyncio
+import time
+from typing import Iterable, Dict, Optional, Set, Union
+from fastapi import WebSocket, status
+from backend.app.dependencies import SessionLocal
+from backend.app.crud import room_crud
+from backend.app.core.logger import logger
+from backend.app.core import doc_sync
+from backend.app.core.broker import RoomBroker
+from backend.app.config.config import settings
+
+# How often buffered editor content is written to the database
+FLUSH_INTERVAL_SECONDS = 0.25
+# How long a room is known to exist (and its document kept in memory) after a client joined it
+ROOM_CACHE_TTL_SECONDS = 30
+# How long a single send may wait for a peer to drain before the peer is dropped
+SEND_TIMEOUT_SECONDS = 5
 
 class ConnectionManager:
-    def __init__(self):
-        # Key: room_id, Value: List of active WebSockets
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+    def __init__(self, broker: Optional[RoomBroker] = None):
+        # Relays frames to other workers when running with several of them (None: single worker)
+        self.broker = broker
+        # Key: room_id, Value: Set of active WebSockets (O(1) add/remove)
+        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        # Key: room_id, Value: Current document of every room being edited
+        self.pending: Dict[str, str] = {}
+        # Key: room_id, Value: Wire frame carrying the pending document, encoded once per change
+        self.encoded: Dict[str, Union[str, bytes]] = {}
+        # Rooms whose pending content has not been persisted yet
+        self.dirty: Set[str] = set()
+        # Key: room_id, Value: time.monotonic() until which the room is known to exist
+        self.known_rooms: Dict[str, float] = {}
+        # Key: WebSocket, Value: Newest message not yet sent, its wake-up signal and the task sending it
+        self.latest: Dict[WebSocket, Union[str, bytes]] = {}
+        self.signals: Dict[WebSocket, asyncio.Event] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
+        self._flush_lock = asyncio.Lock()
 
     async def connect(self, websocket: WebSocket, room_id: str):
         await websocket.accept()
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = []
-        self.active_connections[room_id].append(websocket)
+        connections = self.active_connections.setdefault(room_id, set())
+        if not connections and self.broker:
+            # First client of the room on this worker
+            self.broker.subscribe(room_id, self)
+        connections.add(websocket)
+        # Each socket gets its own writer task, woken up whenever a new frame is waiting
+        self.signals[websocket] = asyncio.Event()
+        self.writers[websocket] = asyncio.create_task(self._writer(websocket, room_id))
 
     def disconnect(self, websocket: WebSocket, room_id: str):
-        if room_id in self.active_connections:
-            self.active_connections[room_id].remove(websocket)
-            if not self.active_connections[room_id]:
+        connections = self.active_connections.get(room_id)
+        if connections is not None:
+            connections.discard(websocket)
+            if not connections:
                 del self.active_connections[room_id]
+                if self.broker:
+                    self.broker.unsubscribe(room_id)
+                self._release_buffer(room_id)
+        self.latest.pop(websocket, None)
+        self.signals.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer:
+            writer.cancel()
+
+    def send_document(self, websocket: WebSocket, room_id: str):
+        """
+        Hands the room's complete document to a single socket, e.g. a newly connected one.
+        Replaces a frame that is still waiting, so a lagging peer only gets the newest state.
+        """
+        self._enqueue(self.document_frame(room_id), websocket)
+
+    def document_frame(self, room_id: str) -> Union[str, bytes]:
+        """
+        Returns the encoded frame carrying the room's document.
+        It is built once per change, so a burst of (re)connecting clients shares it.
+        """
+        frame = self.encoded.get(room_id)
+        if frame is None:
+            frame = doc_sync.encode_frame(doc_sync.code_frame(self.pending[room_id]))
+            self.encoded[room_id] = frame
+        return frame
+
+    async def receive_frame(self, data: str, room_id: str, sender: Optional[WebSocket] = None):
+        """
+        Applies a client frame to the room's document and relays it to the rest of the room.
+        sender is None for frames relayed by another worker, which already persisted
+        and published them.
+        """
+        if sender is None:
+            if room_id not in self.pending:
+                # This worker has no clients left in the room
+                return
+        elif sender not in self.signals:
+            # The sender's writer dropped it after a failed send, its socket is being closed
+            return
+
+        parsed = doc_sync.parse_patch(data)
+        if parsed is None:
+            # Anything but a patch frame is the full content of the editor
+            new_code = data
+            message = doc_sync.code_frame(data)
+        else:
+            patch, base = parsed
+            document = self.pending[room_id]
+            # A different base means a concurrent edit landed first. The patch still merges
+            # if its context is intact; fuzzy matching could put it on the wrong text.
+            strict = base is not None and base != doc_sync.document_hash(document)
+            new_code = doc_sync.apply_patch(document, patch, strict)
+            if new_code is None:
+                if sender is not None:
+                    # The sender's copy has diverged, resync it with the room's document
+                    self.send_document(sender, room_id)
+                else:
+                    # This worker's copy has diverged; the copy picked for the room arrives through receive_document
+                    logger.warning("Patch relayed for room %s does not apply, requesting the document.", room_id)
+                    await self.broker.request_document(room_id, self.pending[room_id])
+                return
+            # Relay the patch as received, its size scales with the edit, not the document
+            message = data
+
+        if sender is None:
+            self._set_document(room_id, new_code)
+            await self.broadcast(message, room_id, sender)
+            return
 
-    async def broadcast(self, message: str, room_id: str, sender: WebSocket):
-        # Broadcast the message to everyone in the room EXCEPT the sender
+        # Buffer the latest content; the background flusher persists it
+        self.buffer_code(room_id, new_code)
+        await self.broadcast(message, room_id, sender)
+        if self.broker:
+            try:
+                await self.broker.publish(room_id, data)
+            except Exception as e:
+                # Local peers already have the edit; a Redis outage must not drop the sender
+                logger.error("Failed to publish frame for room %s: %s", room_id, e)
+
+    async def receive_document(self, code: str, room_id: str):
+        """Replaces this worker's copy with the document picked for the room and resyncs local clients."""
+        if room_id not in self.pending or self.pending[room_id] == code:
+            return
+        # Persisted like a local edit, so the database ends up with the picked copy too
+        self.buffer_code(room_id, code)
+        for connection in self.active_connections.get(room_id, ()):
+            self.send_document(connection, room_id)
+
+    def current_document(self, room_id: str) -> Optional[str]:
+        """Returns this worker's copy for another worker that asked for it."""
+        return self.pending.get(room_id)
+
+    async def broadcast(self, message: str, room_id: str, sender: Optional[WebSocket]):
+        # Broadcast the message to everyone in the room EXCEPT the sender.
+        # Never waits on the network, so a slow client can't block the sender or other peers.
         if room_id in self.active_connections:
-            for connection in self.active_connections[room_id]:
-                if connection != sender:
-                    await connection.send_text(message)
+            # Encode (and compress) once, every receiver gets the same frame
+            frame = None
+            for connection in self.active_connections[room_id] - {sender}:
+                if connection in self.latest:
+                    # The peer still has an unsent frame. A patch only applies on top of it,
+                    # so both are replaced by the complete document.
+                    self._enqueue(self.document_frame(room_id), connection)
+                else:
+                    if frame is None:
+                        frame = doc_sync.encode_frame(message)
+                    self._enqueue(frame, connection)
+
+    def _enqueue(self, frame: Union[str, bytes], websocket: WebSocket):
+        signal = self.signals.get(websocket)
+        if signal is None:
+            # The socket has already been dropped
+            return
+        self.latest[websocket] = frame
+        signal.set()
+
+    async def _writer(self, websocket: WebSocket, room_id: str):
+        """Sends the newest waiting message of one socket until it is disconnected."""
+        signal = self.signals[websocket]
+        try:
+            while True:
+                await signal.wait()
+                signal.clear()
+                frame = self.latest.pop(websocket)
+                # A peer that stopped reading would keep its frames in the transmit buffer forever.
+                # asyncio.timeout, unlike wait_for, never swallows a cancel from disconnect()
+                async with asyncio.timeout(SEND_TIMEOUT_SECONDS):
+                    await self._send(websocket, frame)
+        except asyncio.CancelledError:
+            raise
+        except TimeoutError:
+            logger.warning("Closing WebSocket in room %s that stopped reading.", room_id)
+            await self._close(websocket)
+            self.disconnect(websocket, room_id)
+        except Exception as e:
+            # Prune peers whose socket is gone
+            logger.warning("Dropping unreachable WebSocket from room %s: %s", room_id, e)
+            # Closing it also ends the receive loop, so the dropped client can't keep editing
+            await self._close(websocket)
+            self.disconnect(websocket, room_id)
+
+    @staticmethod
+    async def _send(websocket: WebSocket, frame: Union[str, bytes]):
+        if isinstance(frame, bytes):
+            await websocket.send_bytes(frame)
+        else:
+            await websocket.send_text(frame)
+
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            async with asyncio.timeout(SEND_TIMEOUT_SECONDS):
+                await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        except Exception:
+            # The peer is dropped either way
+            pass
+
+    def cached_document(self, room_id: str) -> Optional[str]:
+        """
+        Returns the in-memory document of a room recently seen in the database.
+        Returns None when the database has to be asked.
+        """
+        if self.known_rooms.get(room_id, 0) < time.monotonic():
+            return None
+        return self.pending.get(room_id)
+
+    def remember_room(self, room_id: str):
+        """Marks the room as existing for the next ROOM_CACHE_TTL_SECONDS."""
+        self.known_rooms[room_id] = time.monotonic() + ROOM_CACHE_TTL_SECONDS
+
+    def open_document(self, room_id: str, code_content: str) -> str:
+        """Returns the in-memory document of a room, loading it from code_content if needed."""
+        return self.pending.setdefault(room_id, code_content)
+
+    def buffer_code(self, room_id: str, code_content: str):
+        """Records the latest code for a room; it is persisted by the next flush."""
+        self._set_document(room_id, code_content)
+        self.dirty.add(room_id)
+
+    async def flush(self, room_ids: Optional[Iterable[str]] = None):
+        """
+        Writes the buffered code of dirty rooms to the database in one transaction.
+        Bursts of edits to a room collapse into a single UPDATE.
+        """
+        # Flushes are serialized so an older snapshot can never overwrite a newer one
+        async with self._flush_lock:
+            rooms = self.dirty if room_ids is None else self.dirty.intersection(room_ids)
+            if not rooms:
+                return
+
+            updates = {room_id: self.pending[room_id] for room_id in rooms}
+            self.dirty.difference_update(updates)
+
+            try:
+                # The write is blocking, keep it off the event loop
+                await asyncio.to_thread(self._persist, updates)
+            except Exception as e:
+                # Keep the rooms dirty so the next flush retries them
+                self.dirty.update(updates)
+                logger.error("Failed to persist code for rooms %s: %s", list(updates), e)
+                return
+
+            for room_id in updates:
+                self._release_buffer(room_id)
+
+    async def run_flusher(self, interval: float = FLUSH_INTERVAL_SECONDS):
+        """Background task: periodically persists buffered code until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+            self.evict_expired_rooms()
+
+    def evict_expired_rooms(self):
+        """Forgets rooms whose cache entry expired and releases their documents."""
+        now = time.monotonic()
+        for room_id in [r for r, expiry in self.known_rooms.items() if expiry < now]:
+            del self.known_rooms[room_id]
+            self._release_buffer(room_id)
+
+    def _set_document(self, room_id: str, code_content: str):
+        self.pending[room_id] = code_content
+        # The cached frame holds the previous document
+        self.encoded.pop(room_id, None)
+
+    @staticmethod
+    def _persist(updates: Dict[str, str]):
+        db = SessionLocal()
+        try:
+            room_crud.update_room_codes(db, updates)
+        finally:
+            db.close()
+
+    def _release_buffer(self, room_id: str):
+        # Drop the buffer of a room nobody is editing once it has been persisted.
+        # With a single worker it is kept while the room is cached, so reconnecting clients
+        # get it without a query; other workers may change the room once nobody here listens.
+        if room_id in self.active_connections or room_id in self.dirty:
+            return
+        if self.broker is None and room_id in self.known_rooms:
+            return
+        self.pending.pop(room_id, None)
+        self.encoded.pop(room_id, None)
 
-manager = ConnectionManager()
+manager = ConnectionManager(RoomBroker(settings.REDIS_URL) if settings.REDIS_URL else None)
@@ -1,20 +1,39 @@
-import uuid
+import secrets
+from typing import Dict
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from backend.app.models.room import Room
 
+_UPDATE_CODE = text("UPDATE rooms SET code_content = :c WHERE room_id = :r")
+
+# Attempts at finding an unused room ID before giving up
+ROOM_ID_ATTEMPTS = 3
+
 def create_room(db: Session) -> str:
     """Generates ID, creates room in DB, and returns ID."""
-    room_id = str(uuid.uuid4())[:8]
-    new_room = Room(room_id=room_id, code_content="")
-    db.add(new_room)
-    db.commit()
-    db.refresh(new_room)
-    return room_id
+    for attempt in range(ROOM_ID_ATTEMPTS):
+        # 8 URL-safe characters carrying 48 random bits
+        room_id = secrets.token_urlsafe(6)
+        new_room = Room(room_id=room_id, code_content="")
+        db.add(new_room)
+        try:
+            db.commit()
+        except IntegrityError:
+            # The ID is already taken, retry with a new one
+            db.rollback()
+            if attempt == ROOM_ID_ATTEMPTS - 1:
+                raise
+            continue
+        # The ID is generated here, so there is nothing to read back from the database
+        return room_id
 
 def get_room_code(db: Session, room_id: str) -> str | None:
     """Retrieves the current code content for a room."""
-    room = db.query(Room).filter(Room.room_id == room_id).first()
-    return room.code_content if room else None
+    # Select the column only, no Room object is needed
+    return db.execute(
+        text("SELECT code_content FROM rooms WHERE room_id = :r"), {"r": room_id}
+    ).scalar()
 
 
 def get_room_by_id(db: Session, room_id: str) -> Room | None:
@@ -22,9 +41,20 @@ def get_room_by_id(db: Session, room_id: str) -> Room | None:
     return db.query(Room).filter(Room.room_id == room_id).first()
 
 
-def update_room_code(db: Session, room_id: str, code_content: str):
-    """Updates the persistent code content for a room."""
-    room = db.query(Room).filter(Room.room_id == room_id).first()
-    if room:
-        room.code_content = code_content
-        db.commit()
\ No newline at end of file
+def update_room_code(db: Session, room_id: str, code_content: str) -> int:
+    """Updates the persistent code content for a room. Returns the number of rooms updated."""
+    # A single UPDATE, without loading the row first
+    result = db.execute(_UPDATE_CODE, {"c": code_content, "r": room_id})
+    db.commit()
+    return result.rowcount
+
+
+def update_room_codes(db: Session, updates: Dict[str, str]):
+    """Persists the code content of several rooms in a single transaction."""
+    if not updates:
+        return
+    db.execute(
+        _UPDATE_CODE,
+        [{"c": code_content, "r": room_id} for room_id, code_content in updates.items()],
+    )
+    db.commit()
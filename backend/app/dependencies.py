@@ -3,9 +3,25 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from backend.app.config.config import settings
 
-engine = create_engine(
-    settings.SQLALCHEMY_DATABASE_URL
 
+def _engine_options(database_url: str) -> dict:
+    """Connection pool settings for the configured database."""
+    if database_url.startswith("sqlite"):
+        # Local SQLite fallback: SQLAlchemy's defaults are fine
+        return {}
+    return {
+        # Enough connections for bursts of /rooms calls and websocket flushes
+        "pool_size": 20,
+        "max_overflow": 40,
+        # Replace connections dropped by the server instead of failing the request
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+
+
+engine = create_engine(
+    settings.SQLALCHEMY_DATABASE_URL,
+    **_engine_options(settings.SQLALCHEMY_DATABASE_URL)
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -1,17 +1,40 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from backend.app.api.v1.endpoints import coding
 from backend.app.dependencies import Base, engine
 from backend.app.config.config import settings
 from backend.app.core.logger import logger
+from backend.app.core.ws_manager import manager
+
+# Use uvloop when it is available (uvicorn picks it with --loop uvloop; this also covers
+# other runners such as pytest). Not available on Windows, where asyncio's loop is kept.
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
 
 # Initialize database tables
 Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title=settings.PROJECT_NAME,version="1.0.0", description="API for a Pair Programming Application")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Runs the background task that persists buffered editor content."""
+    flusher = asyncio.create_task(manager.run_flusher())
+    yield
+    flusher.cancel()
+    # Write whatever is still buffered before shutting down
+    await manager.flush()
+    if manager.broker:
+        await manager.broker.close()
+
+app = FastAPI(title=settings.PROJECT_NAME,version="1.0.0", description="API for a Pair Programming Application", lifespan=lifespan)
 
 
-logger.info(f"Starting {settings.PROJECT_NAME} application.")
+logger.info("Starting %s application.", settings.PROJECT_NAME)
 
 origins = [
     "http://localhost",
@@ -37,8 +60,8 @@ app.add_middleware(
 app.include_router(coding.router, prefix="/api/v1", tags=["Coding"])
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Pair Programming API is running"}
 
 
-# python -m uvicorn backend.app.main:app --reload
\ No newline at end of file
+# python -m uvicorn backend.app.main:app --reload --loop uvloop --http httptools --ws websockets --ws-per-message-deflate false --ws-ping-interval 20 --ws-ping-timeout 20 --ws-max-size 1048576
\ No newline at end of file
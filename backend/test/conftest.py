@@ -0,0 +1,92 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+
+class FakeResult:
+    """Result of FakeSession.execute(): the selected value and the number of rows matched."""
+
+    def __init__(self, value=None, rowcount=0):
+        self.value = value
+        self.rowcount = rowcount
+
+    def scalar(self):
+        return self.value
+
+
+class FakeSession:
+    """
+    Lightweight stand-in for a SQLAlchemy Session, much cheaper to build than MagicMock(spec=Session).
+    Records what was added and executed and counts the other calls.
+    """
+
+    def __init__(self):
+        self.added = []
+        # (statement, params) of every execute() call
+        self.executed = []
+        self.queried = 0
+        self.committed = 0
+        self.rolled_back = 0
+        self.refreshed = 0
+        self.closed = 0
+        # Returned by query(...).filter(...).first() and by execute() respectively
+        self.first_result = None
+        self.result = FakeResult()
+        # Raised by the next commits, in order; None lets a commit succeed
+        self.commit_errors = []
+
+    def query(self, *entities):
+        self.queried += 1
+        return self
+
+    def filter(self, *criteria):
+        return self
+
+    def first(self):
+        return self.first_result
+
+    def add(self, instance):
+        self.added.append(instance)
+
+    def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+        return self.result
+
+    def commit(self):
+        self.committed += 1
+        if self.commit_errors:
+            error = self.commit_errors.pop(0)
+            if error is not None:
+                raise error
+
+    def rollback(self):
+        self.rolled_back += 1
+
+    def refresh(self, instance):
+        self.refreshed += 1
+
+    def close(self):
+        self.closed += 1
+
+
+@pytest.fixture
+def fake_session():
+    """Provides a fresh FakeSession for each test."""
+    return FakeSession()
+
+
+@pytest.fixture(scope="session")
+def test_engine():
+    """In-memory SQLite engine shared by the whole session; StaticPool keeps its single connection."""
+    return create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+
+
+@pytest.fixture(scope="session")
+def test_session_local(test_engine):
+    """Session factory bound to the in-memory test engine."""
+    return sessionmaker(autocommit=False, autoflush=False, bind=test_engine)
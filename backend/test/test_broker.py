@@ -0,0 +1,212 @@
+import pytest
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock
+from backend.app.core import broker as broker_module
+from backend.app.core.broker import RoomBroker, WORKER_ID
+
+
+class FakePubSub:
+    """Minimal stand-in for redis.asyncio.client.PubSub yielding canned messages."""
+    def __init__(self, messages, error=None):
+        self.messages = messages
+        # Raised once the messages are consumed, like a dropped connection
+        self.error = error
+        self.subscribed = []
+        self.closed = False
+
+    async def subscribe(self, channel):
+        self.subscribed.append(channel)
+
+    async def listen(self):
+        for message in self.messages:
+            yield message
+        if self.error:
+            raise self.error
+        # Stay subscribed like a real connection would
+        await asyncio.Event().wait()
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def mock_redis(mocker):
+    """Patches redis.asyncio.from_url and returns the mocked client."""
+    client = MagicMock()
+    client.publish = AsyncMock()
+    client.aclose = AsyncMock()
+    mocker.patch.object(broker_module.redis_asyncio, "from_url", return_value=client)
+    return client
+
+
+@pytest.mark.asyncio
+async def test_publish_tags_origin(mock_redis):
+    """Test frames are published on the room channel together with this worker's ID."""
+    broker = RoomBroker("redis://localhost:6379/0")
+
+    await broker.publish("room_1", "frame")
+
+    channel, payload = mock_redis.publish.await_args[0]
+    assert channel == "room:room_1"
+    assert json.loads(payload) == {"origin": WORKER_ID, "data": "frame"}
+
+
+@pytest.fixture
+def handler():
+    """Provides a mocked RoomHandler."""
+    handler = MagicMock()
+    handler.receive_frame = AsyncMock()
+    handler.receive_document = AsyncMock()
+    handler.current_document = MagicMock(return_value="mine")
+    return handler
+
+
+@pytest.mark.asyncio
+async def test_publish_document_and_request(mock_redis, mocker):
+    """Test documents and document requests are published on the room channel."""
+    broker = RoomBroker("redis://localhost:6379/0")
+
+    mocker.patch.object(broker_module.uuid, "uuid4", return_value=MagicMock(hex="r1"))
+
+    await broker.publish_document("room_1", "code", "r0")
+    await broker.request_document("room_1", "mine")
+
+    payloads = [json.loads(call[0][1]) for call in mock_redis.publish.await_args_list]
+    assert payloads == [
+        {"origin": WORKER_ID, "code": "code", "round": "r0"},
+        {"origin": WORKER_ID, "sync": True, "round": "r1", "code": "mine"},
+    ]
+    # The local copy competes in the round it started
+    assert broker.rounds["room_1"] == ("r1", WORKER_ID)
+
+
+@pytest.mark.asyncio
+async def test_listener_skips_own_messages(mock_redis, handler):
+    """Test only frames published by other workers are handed to the handler."""
+    pubsub = FakePubSub([
+        {"type": "subscribe", "data": 1},
+        {"type": "message", "data": json.dumps({"origin": WORKER_ID, "data": "mine"})},
+        {"type": "message", "data": json.dumps({"origin": "other", "data": "theirs"})},
+    ])
+    mock_redis.pubsub.return_value = pubsub
+    broker = RoomBroker("redis://localhost:6379/0")
+
+    broker.subscribe("room_2", handler)
+    await asyncio.sleep(0.01)
+
+    assert pubsub.subscribed == ["room:room_2"]
+    handler.receive_frame.assert_awaited_once_with("theirs", "room_2")
+
+    await broker.close()
+    await asyncio.sleep(0)
+    assert pubsub.closed
+    assert not broker.listeners
+    mock_redis.aclose.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_listener_requests_document_and_dispatches(mock_redis, handler, mocker):
+    """Test a new subscription asks for the document, adopts the answer and answers later requests."""
+    mocker.patch.object(broker_module.uuid, "uuid4", return_value=MagicMock(hex="r1"))
+    mock_redis.pubsub.return_value = FakePubSub([
+        {"type": "message", "data": json.dumps({"origin": "other", "code": "full", "round": "r1"})},
+        {"type": "message", "data": json.dumps({"origin": "other", "sync": True, "round": "r2"})},
+    ])
+    broker = RoomBroker("redis://localhost:6379/0")
+
+    broker.subscribe("room_4", handler)
+    await asyncio.sleep(0.01)
+
+    published = [call[0] for call in mock_redis.publish.await_args_list]
+    assert [channel for channel, _ in published] == ["room:room_4", "room:room_4"]
+    assert [json.loads(payload) for _, payload in published] == [
+        # A subscribing worker is behind, so it offers no copy of its own
+        {"origin": WORKER_ID, "sync": True, "round": "r1"},
+        {"origin": WORKER_ID, "code": "mine", "round": "r2"},
+    ]
+    handler.receive_document.assert_awaited_once_with("full", "room_4")
+
+    await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_round_adopts_lowest_worker_copy(mock_redis, handler, monkeypatch):
+    """Test the copy of the lowest worker ID in a round wins, whatever the order of the answers."""
+    monkeypatch.setattr(broker_module, "CATCH_UP_SECONDS", 0)
+    mock_redis.pubsub.return_value = FakePubSub([
+        {"type": "message", "data": json.dumps({"origin": "7", "sync": True, "round": "r", "code": "seven"})},
+        {"type": "message", "data": json.dumps({"origin": "3", "code": "three", "round": "r"})},
+        {"type": "message", "data": json.dumps({"origin": "4", "code": "four", "round": "r"})},
+        {"type": "message", "data": json.dumps({"origin": "1", "code": "one", "round": "older"})},
+    ])
+    broker = RoomBroker("redis://localhost:6379/0")
+    broker.worker_id = "5"
+
+    broker.subscribe("room_6", handler)
+    await asyncio.sleep(0.01)
+
+    # The requester's copy ranks below this worker's, which is offered in the round instead
+    assert json.loads(mock_redis.publish.await_args[0][1]) == {"origin": "5", "code": "mine", "round": "r"}
+    handler.receive_document.assert_awaited_once_with("three", "room_6")
+    assert broker.rounds["room_6"] == ("r", "3")
+
+    await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_catching_up_worker_does_not_answer(mock_redis, handler):
+    """Test a worker that just subscribed keeps its copy, which may be behind, out of other rounds."""
+    mock_redis.pubsub.return_value = FakePubSub([
+        {"type": "message", "data": json.dumps({"origin": "0", "sync": True, "round": "r", "code": "theirs"})},
+    ])
+    broker = RoomBroker("redis://localhost:6379/0")
+
+    broker.subscribe("room_7", handler)
+    await asyncio.sleep(0.01)
+
+    # Only its own request went out
+    assert mock_redis.publish.await_count == 1
+    handler.current_document.assert_not_called()
+    handler.receive_document.assert_not_awaited()
+
+    await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_listener_subscribes_again_after_failure(mock_redis, handler, monkeypatch):
+    """Test a failed listener reconnects instead of leaving the room unsubscribed."""
+    monkeypatch.setattr(broker_module, "RECONNECT_DELAY_SECONDS", 0)
+    broken = FakePubSub([], error=ConnectionError("connection lost"))
+    healthy = FakePubSub([
+        {"type": "message", "data": json.dumps({"origin": "other", "data": "after"})},
+    ])
+    mock_redis.pubsub.side_effect = [broken, healthy]
+    broker = RoomBroker("redis://localhost:6379/0")
+
+    broker.subscribe("room_5", handler)
+    await asyncio.sleep(0.01)
+
+    assert broken.closed
+    assert healthy.subscribed == ["room:room_5"]
+    handler.receive_frame.assert_awaited_once_with("after", "room_5")
+    # Each subscription asks for the document, covering frames missed in between
+    assert mock_redis.publish.await_count == 2
+    assert "room_5" in broker.listeners
+
+    await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_is_idempotent(mock_redis, handler):
+    """Test a room gets a single listener no matter how often it is subscribed."""
+    mock_redis.pubsub.return_value = FakePubSub([])
+    broker = RoomBroker("redis://localhost:6379/0")
+
+    broker.subscribe("room_3", handler)
+    first = broker.listeners["room_3"]
+    broker.subscribe("room_3", handler)
+
+    assert broker.listeners["room_3"] is first
+    broker.unsubscribe("room_3")
+    assert "room_3" not in broker.listeners
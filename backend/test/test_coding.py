@@ -5,13 +5,20 @@ from fastapi import status, FastAPI
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 import asyncio
+import json
+import zlib
+from types import SimpleNamespace
 
 # FIX 1: Import WebSocketDisconnect from starlette
 from starlette.websockets import WebSocketDisconnect 
 
+from backend.app.api.v1.endpoints import coding
 from backend.app.api.v1.endpoints.coding import router
 from backend.app.dependencies import get_db
+from backend.app.schemas.room import AutocompleteRequest
+from backend.app.core.ws_manager import manager
 from sqlalchemy.sql.elements import TextClause
+from diff_match_patch import diff_match_patch
 
 
 # --- SETUP FIXTURES AND MOCKS ---
@@ -100,9 +107,22 @@ def test_create_room(client, mocker):
 
     # 4. Verify logging was called with the correct headers
     mock_logger_info.assert_any_call(
-        f"Request to POST /rooms received. Headers logged: {{'x-username': 'TestUser', 'x-usermail': 'test@example.com'}}"
+        "Request to POST /rooms received. Headers logged: %s",
+        {'x-username': 'TestUser', 'x-usermail': 'test@example.com'}
     )
 
+def test_create_room_skips_header_logging_when_info_disabled(client, mocker):
+    """Test the headers are not logged when the INFO level is disabled."""
+    mocker.patch("backend.app.crud.room_crud.create_room", return_value="mocked_room_456")
+    mocker.patch.object(coding, "_log_enabled", return_value=False)
+    mock_logger_info = mocker.patch("backend.app.core.logger.logger.info")
+
+    response = client.post("/api/v1/rooms", headers={"x-username": "TestUser"})
+
+    assert response.status_code == status.HTTP_200_OK
+    # Only the room creation itself is logged
+    mock_logger_info.assert_called_once_with("New room created with ID: %s", "mocked_room_456")
+
 @pytest.mark.parametrize(
     "code, expected_suggestion",
     [
@@ -132,71 +152,182 @@ def test_autocomplete(client, code, expected_suggestion):
     assert response.json()["suggestion"] == expected_suggestion
 
 
+@pytest.mark.asyncio
+async def test_autocomplete_reuses_static_responses():
+    """Test the suggestions are built once and returned as the same objects."""
+    def request(code):
+        return AutocompleteRequest(code=code, cursorPosition=len(code), language="python")
+
+    assert await coding.rest_get_autocomplete(request("def ")) is coding._DEF
+    assert await coding.rest_get_autocomplete(request("class ")) is coding._CLASS
+    assert await coding.rest_get_autocomplete(request("x = 1")) is coding._DEFAULT
+
+
 # --- TEST WEB SOCKET ENDPOINT ---
 
+@pytest.fixture
+def ws_room(mocker):
+    """
+    Returns a function serving the WebSocket endpoint a room holding code_content
+    (None: the room doesn't exist) without a database, and the flusher disabled.
+    It returns the lookup session, the mocked get_room_by_id and the mocked flush.
+    """
+    def setup(code_content=""):
+        room = None if code_content is None else MockRoom(code_content=code_content)
+        mock_session = mocker.MagicMock(spec=Session)
+        mocker.patch("backend.app.api.v1.endpoints.coding.SessionLocal", return_value=mock_session)
+        return SimpleNamespace(
+            session=mock_session,
+            get_room=mocker.patch("backend.app.crud.room_crud.get_room_by_id", return_value=room),
+            flush=mocker.patch("backend.app.core.ws_manager.manager.flush"),
+        )
+    return setup
+
+
 @pytest.mark.asyncio
-async def test_ws_connect_and_disconnect(client, mocker):
+async def test_ws_connect_and_disconnect(client, mocker, ws_room):
     """Test successful connection and graceful disconnection."""
     room_id = "ws_test_room"
-    
-    mock_session = mocker.MagicMock(spec=Session)
-    mock_room = MockRoom(code_content="initial code")
-    mocker.patch("backend.app.crud.room_crud.get_room_by_id", return_value=mock_room)
-    
-    mocker.patch("backend.app.crud.room_crud.update_room_code")
-    mock_disconnect = mocker.patch("backend.app.core.ws_manager.manager.disconnect")
-    
-    # Mock connect to call accept
-    mock_connect = mocker.patch("backend.app.core.ws_manager.manager.connect", new_callable=mock.AsyncMock)
-
-    async def mock_connect_side_effect(websocket, room_id):
-        await websocket.accept() 
-
-    mock_connect.side_effect = mock_connect_side_effect
-    
-    app.dependency_overrides[get_db] = lambda: mock_session
+    room = ws_room("initial code")
+    # Spy on connect/disconnect so the real outbox and writer task are set up and torn down
+    mock_disconnect = mocker.spy(manager, "disconnect")
+    mock_connect = mocker.spy(manager, "connect")
 
     with client.websocket_connect(f"/api/v1/ws/{room_id}") as websocket:
         # 1. Connection check
-        mock_connect.assert_awaited_once() 
-
-        # 2. Initial state check: The code is sent immediately after accept()
-        initial_message = websocket.receive_text() 
-        assert initial_message == "initial code"
-        
-        # 3. Simulate client sending data
-        # await websocket.send_text("def new_func():") 
-        
+        mock_connect.assert_awaited_once()
+
+        # 2. Initial state check: The code is the first message queued after accept()
+        initial_message = websocket.receive_text()
+        assert json.loads(initial_message) == {"code": "initial code"}
+
+        # The lookup session is released while the socket is still open
+        room.session.close.assert_called_once()
+
         await asyncio.sleep(0.01)
 
-    # 4. Disconnection check
+    # 3. Disconnection check
     mock_disconnect.assert_called_once()
-    
-    app.dependency_overrides = {}
 
 
 @pytest.mark.asyncio
-async def test_ws_room_not_found(client, mocker):
+async def test_ws_large_initial_state_is_compressed(client, ws_room):
+    """Test a large document is sent as one zlib-compressed binary frame."""
+    room_id = "ws_large_room"
+    code = "print('hello')\n" * 100
+    ws_room(code)
+
+    with client.websocket_connect(f"/api/v1/ws/{room_id}") as websocket:
+        frame = websocket.receive_bytes()
+
+    assert json.loads(zlib.decompress(frame)) == {"code": code}
+
+
+@pytest.mark.asyncio
+async def test_ws_buffers_code_and_flushes_on_disconnect(client, mocker, ws_room):
+    """Test that received code is buffered in memory and persisted when the client leaves."""
+    room_id = "ws_buffer_room"
+    room = ws_room("")
+    mock_buffer = mocker.patch("backend.app.core.ws_manager.manager.buffer_code")
+
+    with client.websocket_connect(f"/api/v1/ws/{room_id}") as websocket:
+        websocket.send_text("print('hi')")
+
+    await asyncio.sleep(0.01)
+
+    mock_buffer.assert_called_once_with(room_id, "print('hi')")
+    room.flush.assert_called_once_with([room_id])
+
+
+@pytest.mark.asyncio
+async def test_ws_patch_is_applied_and_relayed(client, mocker, ws_room):
+    """Test a patch frame updates the room document and is relayed to peers unchanged."""
+    room_id = "ws_patch_room"
+    ws_room("hello")
+    mock_buffer = mocker.spy(manager, "buffer_code")
+    mock_broadcast = mocker.spy(manager, "broadcast")
+
+    dmp = diff_match_patch()
+    frame = json.dumps({"patch": dmp.patch_toText(dmp.patch_make("hello", "hello world"))})
+
+    with client.websocket_connect(f"/api/v1/ws/{room_id}") as websocket:
+        websocket.receive_text()
+        websocket.send_text(frame)
+
+    await asyncio.sleep(0.01)
+
+    mock_buffer.assert_called_once_with(room_id, "hello world")
+    assert mock_broadcast.call_args[0][:2] == (frame, room_id)
+
+
+@pytest.mark.asyncio
+async def test_ws_failed_patch_resyncs_sender(client, mocker, ws_room):
+    """Test a patch that doesn't apply is answered with the room's complete document."""
+    room_id = "ws_resync_room"
+    ws_room("abc")
+    mock_buffer = mocker.spy(manager, "buffer_code")
+
+    dmp = diff_match_patch()
+    frame = json.dumps({"patch": dmp.patch_toText(dmp.patch_make("something else entirely", "x"))})
+
+    with client.websocket_connect(f"/api/v1/ws/{room_id}") as websocket:
+        assert json.loads(websocket.receive_text()) == {"code": "abc"}
+        websocket.send_text(frame)
+        assert json.loads(websocket.receive_text()) == {"code": "abc"}
+
+    mock_buffer.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_ws_unexpected_error_still_disconnects(client, mocker, ws_room):
+    """Test the socket is removed from the manager and flushed when handling a frame fails."""
+    room_id = "ws_error_room"
+    room = ws_room("")
+    mocker.patch.object(manager, "receive_frame", side_effect=RuntimeError("boom"))
+    mock_disconnect = mocker.spy(manager, "disconnect")
+
+    with pytest.raises(RuntimeError):
+        with client.websocket_connect(f"/api/v1/ws/{room_id}") as websocket:
+            websocket.receive_text()
+            websocket.send_text("print('hi')")
+            websocket.receive_text()
+
+    mock_disconnect.assert_called_once()
+    room.flush.assert_called_once_with([room_id])
+    assert room_id not in manager.active_connections
+
+
+@pytest.mark.asyncio
+async def test_ws_reconnect_skips_room_query(client, ws_room):
+    """Test a client rejoining a recently opened room is served without a database query."""
+    room_id = "ws_reconnect_room"
+    room = ws_room("stored")
+
+    with client.websocket_connect(f"/api/v1/ws/{room_id}") as websocket:
+        websocket.receive_text()
+        websocket.send_text("edited")
+
+    with client.websocket_connect(f"/api/v1/ws/{room_id}") as websocket:
+        # The freshest edit is served, not the stored row
+        assert json.loads(websocket.receive_text()) == {"code": "edited"}
+
+    room.get_room.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_ws_room_not_found(client, mocker, ws_room):
     """Test connection attempt with a non-existent room."""
     room_id = "non_existent_room"
-
-    # Mock dependencies
-    mock_session = mocker.MagicMock(spec=Session)
-    mocker.patch("backend.app.crud.room_crud.get_room_by_id", return_value=None)
+    ws_room(None)
     mock_logger_warning = mocker.patch("backend.app.core.logger.logger.warning")
-    
-    app.dependency_overrides[get_db] = lambda: mock_session
 
     # Catch the correct exception: WebSocketDisconnect (now imported)
-    with pytest.raises(WebSocketDisconnect): 
+    with pytest.raises(WebSocketDisconnect):
         with client.websocket_connect(f"/api/v1/ws/{room_id}") as websocket:
             # The endpoint should immediately close the connection upon checking the room
             pass
 
     # Verify the warning was logged
     mock_logger_warning.assert_called_once_with(
-        f"WebSocket rejected connection for unknown room ID: {room_id}"
+        "WebSocket rejected connection for unknown room ID: %s", room_id
     )
-
-    app.dependency_overrides = {}
-
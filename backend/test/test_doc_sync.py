@@ -0,0 +1,118 @@
+import json
+import zlib
+import pytest
+from diff_match_patch import diff_match_patch
+from backend.app.core import doc_sync
+
+dmp = diff_match_patch()
+
+
+def make_patch(old: str, new: str) -> str:
+    return dmp.patch_toText(dmp.patch_make(old, new))
+
+
+# --- Tests for frame parsing ---
+
+def test_code_frame():
+    """Test the full-document frame structure."""
+    assert json.loads(doc_sync.code_frame("print('hi')")) == {"code": "print('hi')"}
+
+
+def test_encode_frame_small_stays_text():
+    """Test frames below the threshold are sent uncompressed as text."""
+    frame = doc_sync.code_frame("x")
+    assert doc_sync.encode_frame(frame) == frame
+
+
+def test_encode_frame_large_is_compressed():
+    """Test frames above the threshold become zlib-compressed bytes."""
+    frame = doc_sync.code_frame("a" * doc_sync.COMPRESSION_MIN_SIZE)
+    encoded = doc_sync.encode_frame(frame)
+
+    assert isinstance(encoded, bytes)
+    assert len(encoded) < len(frame)
+    assert zlib.decompress(encoded).decode() == frame
+
+
+def test_document_hash_is_crc32_of_utf8():
+    """Test the base hash matches the CRC-32 the frontend computes over UTF-8 bytes."""
+    assert doc_sync.document_hash("print('héllo')") == zlib.crc32("print('héllo')".encode())
+    assert doc_sync.document_hash("a") != doc_sync.document_hash("b")
+
+
+def test_parse_patch_frame():
+    """Test the patch text and base hash are extracted from a patch frame."""
+    patch = make_patch("a", "ab")
+    base = doc_sync.document_hash("a")
+    assert doc_sync.parse_patch(json.dumps({"base": base, "patch": patch})) == (patch, base)
+
+
+@pytest.mark.parametrize("base", [None, "123", True])
+def test_parse_patch_frame_without_valid_base(base):
+    """Test a missing or malformed base is reported as None."""
+    patch = make_patch("a", "ab")
+    frame = {"patch": patch} if base is None else {"base": base, "patch": patch}
+    assert doc_sync.parse_patch(json.dumps(frame)) == (patch, None)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        "def main():\n    pass",       # Plain editor buffer
+        "{ not json",                   # Looks like JSON but isn't
+        '{"code": "x"}',                # JSON without a patch
+        '{"patch": 42}',                # Patch of the wrong type
+    ]
+)
+def test_parse_patch_other_data(data):
+    """Test anything that isn't a patch frame is reported as such."""
+    assert doc_sync.parse_patch(data) is None
+
+
+# --- Tests for apply_patch ---
+
+def test_apply_patch_success():
+    """Test a patch made against the document applies cleanly."""
+    document = "def hello():\n    pass\n"
+    edited = "def hello():\n    return 'hi'\n"
+
+    assert doc_sync.apply_patch(document, make_patch(document, edited)) == edited
+
+
+def test_apply_patch_on_concurrently_edited_document():
+    """Test a patch still applies when an unrelated part of the document changed."""
+    base = "first line\n" + "filler\n" * 20 + "last line\n"
+    patch = make_patch(base, base.replace("last line", "final line"))
+    concurrent = base.replace("first line", "top line")
+
+    assert doc_sync.apply_patch(concurrent, patch) == concurrent.replace("last line", "final line")
+
+
+def test_apply_patch_strict_on_concurrently_edited_document():
+    """Test a strict patch still applies when its context is intact but has moved."""
+    base = "first line\n" + "filler\n" * 20 + "last line\n"
+    patch = make_patch(base, base.replace("last line", "final line"))
+    concurrent = base.replace("first line", "top line")
+
+    assert doc_sync.apply_patch(concurrent, patch, strict=True) == concurrent.replace("last line", "final line")
+
+
+def test_apply_patch_strict_rejects_changed_context():
+    """Test a strict patch whose context was edited concurrently is refused instead of applied fuzzily."""
+    patch = make_patch("x = 1\n", "x = 10\n")
+    concurrent = "x = 1\ny = 2\n"
+
+    # Fuzzy matching lands the edit on the wrong line
+    assert doc_sync.apply_patch(concurrent, patch) == "x = 1\ny = 20\n"
+    assert doc_sync.apply_patch(concurrent, patch, strict=True) is None
+
+
+def test_apply_patch_mismatch():
+    """Test None is returned when the patch doesn't fit the document."""
+    patch = make_patch("something else entirely", "x")
+    assert doc_sync.apply_patch("abc", patch) is None
+
+
+def test_apply_patch_malformed():
+    """Test None is returned for patch text that can't be parsed."""
+    assert doc_sync.apply_patch("abc", "@@ garbage") is None
@@ -1,6 +1,6 @@
 import pytest
 from unittest import mock
-from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
 from backend.app.crud import room_crud
 from backend.app.models.room import Room 
 
@@ -25,47 +25,29 @@ class MockRoom:
             return self.room_id == other.room_id
         return NotImplemented
 
-# Mock UUID generation globally for predictability in create_room
-@pytest.fixture(autouse=True)
-def mock_uuid(mocker):
-    """Mocks uuid.uuid4() to return a predictable value for create_room testing."""
-    mock_id = mocker.MagicMock()
-    mock_id.hex = "0123456789abcdef" 
-    
-    # Mock the full uuid4 result (which is a UUID object)
-    mock_uuid4_result = mocker.MagicMock()
-    mock_uuid4_result.__str__.return_value = mock_id.hex 
-    
-    mocker.patch("backend.app.crud.room_crud.uuid.uuid4", return_value=mock_uuid4_result)
-
-
+# Mock room ID generation for predictability; only the create_room tests request it
 @pytest.fixture
-def mock_db_session(mocker):
-    """Provides a mocked SQLAlchemy Session."""
-    mock_session = mocker.MagicMock(spec=Session)
-    
-    # Mock the query object chain
-    mock_query = mock_session.query.return_value
-    mock_filter = mock_query.filter.return_value
-    
-    # Reset the default .first() return value for fresh tests
-    mock_filter.first.return_value = None 
-    
-    return mock_session
+def mock_token(mocker):
+    """Mocks secrets.token_urlsafe() to return predictable room IDs for create_room testing."""
+    return mocker.patch(
+        "backend.app.crud.room_crud.secrets.token_urlsafe",
+        side_effect=["AbCd-_12", "EfGh-_34", "IjKl-_56"]
+    )
+
 
 # --- Tests for create_room ---
 
-def test_create_room_success(mock_db_session, mocker):
+def test_create_room_success(fake_session, mock_token, mocker):
     """Test successful room creation and DB interaction."""
     
-    # The expected ID is the first 8 characters of the mocked uuid
-    expected_room_id = "01234567"
+    # The expected ID is the first generated token
+    expected_room_id = "AbCd-_12"
 
     # We mock the Room model instantiation to ensure the correct values are passed
     mock_room_model = mocker.patch("backend.app.crud.room_crud.Room", side_effect=MockRoom)
     
     # 1. Execute the function
-    returned_id = room_crud.create_room(mock_db_session)
+    returned_id = room_crud.create_room(fake_session)
     
     # 2. Assert the expected ID is returned
     assert returned_id == expected_room_id
@@ -77,108 +59,121 @@ def test_create_room_success(mock_db_session, mocker):
     )
     
     # 4. Assert DB session commands were called
-    mock_db_session.add.assert_called_once()
-    mock_db_session.commit.assert_called_once()
-    mock_db_session.refresh.assert_called_once()
+    assert len(fake_session.added) == 1
+    assert fake_session.committed == 1
+    # No extra SELECT to reload the row
+    assert fake_session.refreshed == 0
 
 
-# --- Tests for get_room_code ---
+def test_create_room_retries_on_id_collision(fake_session, mock_token):
+    """Test a colliding room ID is rolled back and a fresh one is used."""
+    fake_session.commit_errors = [IntegrityError("INSERT", {}, Exception("duplicate key"))]
 
-def test_get_room_code_success(mock_db_session):
-    """Test successful retrieval of code content."""
-    test_id = "test_id_1"
-    test_content = "def hello(): pass"
-    
-    # Setup the mock query to return a Room object
-    mock_room = MockRoom(room_id=test_id, code_content=test_content)
-    mock_db_session.query.return_value.filter.return_value.first.return_value = mock_room
-    
-    # 1. Execute the function
-    code = room_crud.get_room_code(mock_db_session, test_id)
-    
-    # 2. Assert the correct code is returned
-    assert code == test_content
-    
-    # 3. Assert the query was constructed correctly (checking the call to filter is sufficient)
-    mock_db_session.query.assert_called_once_with(Room)
-    mock_db_session.query.return_value.filter.assert_called_once()
-    
+    returned_id = room_crud.create_room(fake_session)
 
-def test_get_room_code_not_found(mock_db_session):
-    """Test case where the room ID does not exist."""
-    test_id = "non_existent"
-    
-    # Setup the mock query to return None (the default setup in the fixture)
-    
-    # 1. Execute the function
-    code = room_crud.get_room_code(mock_db_session, test_id)
-    
-    # 2. Assert None is returned
-    assert code is None
+    assert returned_id == "EfGh-_34"
+    assert mock_token.call_count == 2
+    mock_token.assert_called_with(6)
+    assert fake_session.rolled_back == 1
 
 
-# --- Tests for get_room_by_id ---
+def test_create_room_gives_up_after_repeated_collisions(fake_session, mock_token):
+    """Test the IntegrityError propagates once every attempt collided."""
+    fake_session.commit_errors = [
+        IntegrityError("INSERT", {}, Exception("duplicate key"))
+    ] * room_crud.ROOM_ID_ATTEMPTS
 
-def test_get_room_by_id_success(mock_db_session):
-    """Test successful retrieval of the Room object."""
-    test_id = "test_id_2"
-    
-    # Setup the mock query to return a Room object
-    expected_room = MockRoom(room_id=test_id, code_content="")
-    mock_db_session.query.return_value.filter.return_value.first.return_value = expected_room
-    
-    # 1. Execute the function
-    room = room_crud.get_room_by_id(mock_db_session, test_id)
-    
-    # 2. Assert the correct object is returned
-    assert room == expected_room
-    assert room.room_id == test_id
-    
-    
-def test_get_room_by_id_not_found(mock_db_session):
-    """Test case where the Room object is not found."""
-    test_id = "non_existent_2"
-    
-    # Setup the mock query to return None (the default setup in the fixture)
-    
-    # 1. Execute the function
-    room = room_crud.get_room_by_id(mock_db_session, test_id)
-    
-    # 2. Assert None is returned
-    assert room is None
+    with pytest.raises(IntegrityError):
+        room_crud.create_room(fake_session)
+
+    assert fake_session.rolled_back == room_crud.ROOM_ID_ATTEMPTS
+
+
+# --- Tests for get_room_code and get_room_by_id ---
+
+@pytest.mark.parametrize(
+    "lookup, stored, expected",
+    [
+        (room_crud.get_room_code, "def hello(): pass", "def hello(): pass"),
+        (room_crud.get_room_code, None, None),
+        (room_crud.get_room_by_id, MockRoom(room_id="test_id", code_content=""), MockRoom(room_id="test_id", code_content="")),
+        (room_crud.get_room_by_id, None, None),
+    ],
+    ids=["code_found", "code_not_found", "room_found", "room_not_found"]
+)
+def test_room_lookup(fake_session, lookup, stored, expected):
+    """Test the lookups return the stored value, or None when the room does not exist."""
+    # get_room_code selects the column with a raw statement, get_room_by_id uses the ORM query
+    fake_session.result.value = stored
+    fake_session.first_result = stored
+
+    assert lookup(fake_session, "test_id") == expected
+
+
+def test_get_room_code_selects_column_only(fake_session):
+    """Test only the column is selected, without building a Room object."""
+    test_id = "test_id_1"
+
+    room_crud.get_room_code(fake_session, test_id)
+
+    [(statement, params)] = fake_session.executed
+    assert str(statement) == "SELECT code_content FROM rooms WHERE room_id = :r"
+    assert params == {"r": test_id}
+    assert fake_session.queried == 0
 
 
 # --- Tests for update_room_code ---
 
-def test_update_room_code_success(mock_db_session):
+def test_update_room_code_success(fake_session):
     """Test successful update of code content and commit."""
     test_id = "test_id_3"
     new_content = "print('new code')"
-    initial_room = MockRoom(room_id=test_id, code_content="old code")
     
-    # Setup the mock query to return the Room object
-    mock_db_session.query.return_value.filter.return_value.first.return_value = initial_room
+    # Setup the fake statement result to report one updated row
+    fake_session.result.rowcount = 1
     
     # 1. Execute the function
-    room_crud.update_room_code(mock_db_session, test_id, new_content)
+    updated = room_crud.update_room_code(fake_session, test_id, new_content)
     
-    # 2. Assert the object's attribute was updated
-    assert initial_room.code_content == new_content
+    # 2. Assert a single UPDATE was issued, without loading the row first
+    assert updated == 1
+    [(statement, params)] = fake_session.executed
+    assert str(statement) == "UPDATE rooms SET code_content = :c WHERE room_id = :r"
+    assert params == {"c": new_content, "r": test_id}
+    assert fake_session.queried == 0
     
     # 3. Assert DB session commands were called
-    mock_db_session.commit.assert_called_once()
+    assert fake_session.committed == 1
 
 
-def test_update_room_code_room_not_found(mock_db_session):
-    """Test update when the room does not exist (should do nothing)."""
+def test_update_room_code_room_not_found(fake_session):
+    """Test update when the room does not exist (no row is changed)."""
     test_id = "non_existent_3"
     new_content = "bad update"
     
-    # Setup the mock query to return None (the default setup)
-    mock_db_session.query.return_value.filter.return_value.first.return_value = None
+    # The fake statement result reports that no row matched (the default)
     
     # 1. Execute the function
-    room_crud.update_room_code(mock_db_session, test_id, new_content)
+    updated = room_crud.update_room_code(fake_session, test_id, new_content)
     
-    # 2. Assert DB session commands were NOT called
-    mock_db_session.commit.assert_not_called()
\ No newline at end of file
+    # 2. Assert nothing was updated
+    assert updated == 0
+
+
+# --- Tests for update_room_codes ---
+
+def test_update_room_codes_batches_in_one_commit(fake_session):
+    """Test that several rooms are updated with one statement and one commit."""
+    room_crud.update_room_codes(fake_session, {"room_1": "a", "room_2": "b"})
+
+    [(_, params)] = fake_session.executed
+    assert params == [{"c": "a", "r": "room_1"}, {"c": "b", "r": "room_2"}]
+    assert fake_session.committed == 1
+
+
+def test_update_room_codes_empty(fake_session):
+    """Test that no statement is issued when there is nothing to update."""
+    room_crud.update_room_codes(fake_session, {})
+
+    assert fake_session.executed == []
+    assert fake_session.committed == 0
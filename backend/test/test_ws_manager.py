@@ -1,28 +1,72 @@
 import pytest
+import pytest_asyncio
 from unittest import mock
 from unittest.mock import AsyncMock
-from backend.app.core.ws_manager import ConnectionManager
+import asyncio
+import time
+import json
+import zlib
+from diff_match_patch import diff_match_patch
+from backend.app.core.ws_manager import ConnectionManager, ROOM_CACHE_TTL_SECONDS
+from backend.app.core import doc_sync
+from backend.app.core import broker as broker_module
+from backend.app.core.broker import RoomBroker
 
 # --- Fixtures ---
 
-@pytest.fixture
-def manager():
-    """Provides a fresh ConnectionManager instance for each test."""
-    return ConnectionManager()
+@pytest_asyncio.fixture
+async def manager():
+    """Provides a fresh ConnectionManager instance for each test and cancels its leftover writer tasks."""
+    manager = ConnectionManager()
+    yield manager
+    # A writer stuck on a send would otherwise keep the test's event loop from shutting down
+    writers = list(manager.writers.values())
+    for writer in writers:
+        writer.cancel()
+    await asyncio.gather(*writers, return_exceptions=True)
 
-@pytest.fixture
-def mock_websocket_factory():
+class FakeWS:
     """
-    Returns a factory function to create a mocked WebSocket object.
-    Each mock has an AsyncMock for accept and send_text.
+    Lightweight WebSocket stand-in, much cheaper to build than a spec'd MagicMock.
+    Records every frame sent to it (text and binary, in order) and the close codes.
     """
-    def _factory(name: str):
-        mock_ws = mock.MagicMock(spec=['accept', 'send_text', 'close'], name=name)
-        # Ensure accept and send_text are awaitable
-        mock_ws.accept = AsyncMock()
-        mock_ws.send_text = AsyncMock()
-        return mock_ws
-    return _factory
+
+    def __init__(self, name: str):
+        self.name = name
+        self.sent = []
+        self.accept_calls = 0
+        self.close_codes = []
+        # Optional coroutine function awaited before a frame counts as sent (to stall or fail sends)
+        self.on_send = None
+
+    async def accept(self):
+        self.accept_calls += 1
+
+    async def send_text(self, message):
+        await self._send(message)
+
+    async def send_bytes(self, data):
+        await self._send(data)
+
+    async def close(self, code=1000):
+        self.close_codes.append(code)
+
+    async def _send(self, frame):
+        if self.on_send:
+            await self.on_send(frame)
+        self.sent.append(frame)
+
+    def __repr__(self):
+        return f"FakeWS({self.name!r})"
+
+@pytest.fixture
+def mock_websocket_factory():
+    """Returns a factory function to create a FakeWS."""
+    return FakeWS
+
+async def drain_writers():
+    """Gives the per-connection writer tasks a chance to send waiting messages."""
+    await asyncio.sleep(0.01)
 
 # --- Tests ---
 
@@ -36,9 +80,9 @@ async def test_connect_new_room(manager, mock_websocket_factory):
     await manager.connect(ws, room_id)
     
     # 2. Assert connection logic
-    ws.accept.assert_awaited_once()
+    assert ws.accept_calls == 1
     assert room_id in manager.active_connections
-    assert manager.active_connections[room_id] == [ws]
+    assert manager.active_connections[room_id] == {ws}
 
 @pytest.mark.asyncio
 async def test_connect_existing_room(manager, mock_websocket_factory):
@@ -48,15 +92,15 @@ async def test_connect_existing_room(manager, mock_websocket_factory):
     ws2 = mock_websocket_factory("ws2")
 
     # Setup existing connection
-    manager.active_connections[room_id] = [ws1]
+    manager.active_connections[room_id] = {ws1}
     
     # 1. Connect the second socket
     await manager.connect(ws2, room_id)
     
     # 2. Assert connection logic
-    ws2.accept.assert_awaited_once()
+    assert ws2.accept_calls == 1
     assert room_id in manager.active_connections
-    assert manager.active_connections[room_id] == [ws1, ws2]
+    assert manager.active_connections[room_id] == {ws1, ws2}
 
 def test_disconnect_last_user(manager, mock_websocket_factory):
     """Test disconnecting the last user, which should remove the room key."""
@@ -64,7 +108,7 @@ def test_disconnect_last_user(manager, mock_websocket_factory):
     ws = mock_websocket_factory("ws1")
     
     # Setup state
-    manager.active_connections[room_id] = [ws]
+    manager.active_connections[room_id] = {ws}
     
     # 1. Disconnect
     manager.disconnect(ws, room_id)
@@ -81,7 +125,7 @@ def test_disconnect_middle_user(manager, mock_websocket_factory):
     ws3 = mock_websocket_factory("ws3")
     
     # Setup state
-    manager.active_connections[room_id] = [ws1, ws2, ws3]
+    manager.active_connections[room_id] = {ws1, ws2, ws3}
     
     # 1. Disconnect the middle user (ws2)
     manager.disconnect(ws2, room_id)
@@ -90,7 +134,7 @@ def test_disconnect_middle_user(manager, mock_websocket_factory):
     assert room_id in manager.active_connections
     assert ws2 not in manager.active_connections[room_id]
     assert len(manager.active_connections[room_id]) == 2
-    assert manager.active_connections[room_id] == [ws1, ws3]
+    assert manager.active_connections[room_id] == {ws1, ws3}
 
 def test_disconnect_non_existent_room(manager, mock_websocket_factory):
     """Test calling disconnect on a room that doesn't exist (should not fail)."""
@@ -111,18 +155,44 @@ async def test_broadcast_to_multiple_receivers(manager, mock_websocket_factory):
     message = "test message"
     
     # Setup state
-    manager.active_connections[room_id] = [sender, receiver1, receiver2]
+    for ws in (sender, receiver1, receiver2):
+        await manager.connect(ws, room_id)
     
-    # 1. Broadcast
+    # 1. Broadcast and let the writer tasks drain the outboxes
     await manager.broadcast(message, room_id, sender)
+    await drain_writers()
     
     # 2. Assertions
     # Sender should NOT receive the message
-    sender.send_text.assert_not_awaited()
+    assert sender.sent == []
     
     # Receivers SHOULD receive the message
-    receiver1.send_text.assert_awaited_once_with(message)
-    receiver2.send_text.assert_awaited_once_with(message)
+    assert receiver1.sent == [message]
+    assert receiver2.sent == [message]
+
+@pytest.mark.asyncio
+async def test_broadcast_sends_to_receivers_concurrently(manager, mock_websocket_factory):
+    """Test slow receivers are sent to in parallel: delivery takes max(send), not sum(send)."""
+    room_id = "room_ee"
+    sender = mock_websocket_factory("sender")
+    receivers = [mock_websocket_factory(f"receiver{i}") for i in range(10)]
+
+    async def slow_send(message):
+        await asyncio.sleep(0.05)
+    for ws in receivers:
+        ws.on_send = slow_send
+        await manager.connect(ws, room_id)
+    await manager.connect(sender, room_id)
+
+    start = time.perf_counter()
+    await manager.broadcast("message", room_id, sender)
+    while not all(ws.sent for ws in receivers):
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    # Sent one after the other this would take 10 * 0.05s
+    assert elapsed < 0.1
+    assert all(ws.sent == ["message"] for ws in receivers)
 
 @pytest.mark.asyncio
 async def test_broadcast_no_other_receivers(manager, mock_websocket_factory):
@@ -132,14 +202,14 @@ async def test_broadcast_no_other_receivers(manager, mock_websocket_factory):
     message = "test message"
     
     # Setup state
-    manager.active_connections[room_id] = [sender]
+    manager.active_connections[room_id] = {sender}
     
     # 1. Broadcast
     await manager.broadcast(message, room_id, sender)
     
     # 2. Assertions
     # Sender should NOT receive the message, and no other calls should be made
-    sender.send_text.assert_not_awaited()
+    assert sender.sent == []
 
 @pytest.mark.asyncio
 async def test_broadcast_non_existent_room(manager, mock_websocket_factory):
@@ -149,5 +219,606 @@ async def test_broadcast_non_existent_room(manager, mock_websocket_factory):
     
     # No exception should be raised
     await manager.broadcast("message", room_id, sender)
-    # The sender's mock should definitely not be called, as it's not connected anywhere
-    sender.send_text.assert_not_awaited()
\ No newline at end of file
+    # The sender should definitely not be sent anything, as it's not connected anywhere
+    assert sender.sent == []
+
+@pytest.mark.asyncio
+async def test_broadcast_compresses_large_message_once(manager, mock_websocket_factory, mocker):
+    """Test a large message is compressed once and the same binary frame goes to every receiver."""
+    room_id = "room_r"
+    sender = mock_websocket_factory("sender")
+    receivers = [mock_websocket_factory(f"receiver{i}") for i in range(3)]
+    message = doc_sync.code_frame("x = 1\n" * 200)
+    mock_compress = mocker.spy(doc_sync.zlib, "compress")
+
+    for ws in (sender, *receivers):
+        await manager.connect(ws, room_id)
+
+    await manager.broadcast(message, room_id, sender)
+    await drain_writers()
+
+    mock_compress.assert_called_once()
+    assert all(len(ws.sent) == 1 for ws in receivers)
+    frames = [ws.sent[0] for ws in receivers]
+    assert isinstance(frames[0], bytes)
+    assert all(frame is frames[0] for frame in frames)
+    assert zlib.decompress(frames[0]).decode() == message
+
+@pytest.mark.asyncio
+async def test_broadcast_prunes_failed_receivers(manager, mock_websocket_factory):
+    """Test a failing receiver is disconnected while the others still get the message."""
+    room_id = "room_m"
+    sender = mock_websocket_factory("sender")
+    broken = mock_websocket_factory("broken")
+    healthy = mock_websocket_factory("healthy")
+
+    async def failing_send(message):
+        raise RuntimeError("socket closed")
+    broken.on_send = failing_send
+
+    for ws in (sender, broken, healthy):
+        await manager.connect(ws, room_id)
+
+    await manager.broadcast("message", room_id, sender)
+    await drain_writers()
+
+    assert healthy.sent == ["message"]
+    assert broken.close_codes == [1011]
+    assert manager.active_connections[room_id] == {sender, healthy}
+
+@pytest.mark.asyncio
+async def test_receive_frame_from_dropped_sender_is_ignored(manager, mock_websocket_factory):
+    """Test frames still read from a socket dropped after a failed send neither change nor reach the room."""
+    room_id = "room_mb"
+    broken = mock_websocket_factory("broken")
+    peer = mock_websocket_factory("peer")
+
+    async def failing_send(message):
+        raise RuntimeError("socket closed")
+    broken.on_send = failing_send
+
+    await manager.connect(broken, room_id)
+    await manager.connect(peer, room_id)
+    manager.open_document(room_id, "x = 1\n")
+    manager.send_document(broken, room_id)
+    await drain_writers()
+
+    await manager.receive_frame("from dropped socket", room_id, broken)
+    # A resync for the dropped socket is skipped instead of failing
+    manager.send_document(broken, room_id)
+    await drain_writers()
+
+    assert manager.pending[room_id] == "x = 1\n"
+    assert peer.sent == []
+    assert broken not in manager.latest
+
+@pytest.mark.asyncio
+async def test_writer_drops_peer_that_stops_reading(manager, mock_websocket_factory, monkeypatch):
+    """Test a send that doesn't complete in time closes the socket with 1011 and drops it."""
+    monkeypatch.setattr("backend.app.core.ws_manager.SEND_TIMEOUT_SECONDS", 0.001)
+    room_id = "room_t"
+    sender = mock_websocket_factory("sender")
+    stuck = mock_websocket_factory("stuck")
+
+    async def never_drains(message):
+        await asyncio.Event().wait()
+    stuck.on_send = never_drains
+
+    await manager.connect(sender, room_id)
+    await manager.connect(stuck, room_id)
+    await manager.broadcast("message", room_id, sender)
+    await drain_writers()
+
+    assert stuck.close_codes == [1011]
+    assert stuck.sent == []
+    assert manager.active_connections[room_id] == {sender}
+    assert stuck not in manager.writers
+
+@pytest.mark.asyncio
+async def test_broadcast_lagging_peer_gets_latest_only(manager, mock_websocket_factory):
+    """Test that updates piling up for a busy peer collapse into the newest state."""
+    room_id = "room_o"
+    sender = mock_websocket_factory("sender")
+    slow = mock_websocket_factory("slow")
+    release = asyncio.Event()
+
+    async def blocked_send(message):
+        await release.wait()
+    slow.on_send = blocked_send
+
+    await manager.connect(sender, room_id)
+    await manager.connect(slow, room_id)
+
+    # The first update occupies the writer, the following ones pile up
+    manager.buffer_code(room_id, "v1")
+    await manager.broadcast("patch 1", room_id, sender)
+    await drain_writers()
+    for version in (2, 3, 4):
+        manager.buffer_code(room_id, f"v{version}")
+        await manager.broadcast(f"patch {version}", room_id, sender)
+    release.set()
+    await drain_writers()
+
+    # Patches can't be skipped, so the backlog is replaced by the complete document
+    assert slow.sent == ["patch 1", doc_sync.code_frame("v4")]
+
+@pytest.mark.asyncio
+async def test_send_document_superseded_by_newer_broadcast(manager, mock_websocket_factory):
+    """Test a document frame still waiting is replaced by the newer room state."""
+    room_id = "room_p"
+    sender = mock_websocket_factory("sender")
+    newcomer = mock_websocket_factory("newcomer")
+
+    await manager.connect(sender, room_id)
+    await manager.connect(newcomer, room_id)
+    manager.open_document(room_id, "initial")
+    manager.send_document(newcomer, room_id)
+    manager.buffer_code(room_id, "initial + update")
+    await manager.broadcast("update patch", room_id, sender)
+    await drain_writers()
+
+    assert newcomer.sent == [doc_sync.code_frame("initial + update")]
+
+@pytest.mark.asyncio
+async def test_send_document_encodes_once_per_change(manager, mock_websocket_factory, mocker):
+    """Test joining clients share one encoded document frame until the document changes."""
+    room_id = "room_s"
+    clients = [mock_websocket_factory(f"client{i}") for i in range(3)]
+    mock_encode = mocker.spy(doc_sync, "encode_frame")
+
+    manager.open_document(room_id, "v1")
+    for ws in clients:
+        await manager.connect(ws, room_id)
+        manager.send_document(ws, room_id)
+    await drain_writers()
+
+    mock_encode.assert_called_once()
+    for ws in clients:
+        assert ws.sent == [doc_sync.code_frame("v1")]
+
+    # An edit invalidates the cached frame
+    manager.buffer_code(room_id, "v2")
+    assert manager.document_frame(room_id) == doc_sync.code_frame("v2")
+    assert mock_encode.call_count == 2
+
+def test_disconnect_unknown_websocket(manager, mock_websocket_factory):
+    """Test disconnecting a socket that was already removed (should not fail)."""
+    room_id = "room_n"
+    ws1 = mock_websocket_factory("ws1")
+    ws2 = mock_websocket_factory("ws2")
+    manager.active_connections[room_id] = {ws1}
+
+    manager.disconnect(ws2, room_id)
+
+    assert manager.active_connections[room_id] == {ws1}
+
+
+# --- Tests for buffered persistence ---
+
+def test_open_document_keeps_newer_state(manager):
+    """Test that the in-memory document wins over the stored one once a room is open."""
+    assert manager.open_document("room_q", "stored") == "stored"
+    manager.buffer_code("room_q", "edited")
+
+    assert manager.open_document("room_q", "stored") == "edited"
+    assert manager.dirty == {"room_q"}
+
+def test_cached_document_requires_known_room(manager):
+    """Test the in-memory document is only served for rooms confirmed recently."""
+    manager.open_document("room_x", "code")
+    assert manager.cached_document("room_x") is None
+
+    manager.remember_room("room_x")
+    assert manager.cached_document("room_x") == "code"
+
+def test_cached_document_expires(manager, mocker):
+    """Test the cache entry stops being used once its TTL has passed."""
+    mock_time = mocker.patch("backend.app.core.ws_manager.time.monotonic", return_value=100.0)
+    manager.open_document("room_y", "code")
+    manager.remember_room("room_y")
+
+    mock_time.return_value = 100.0 + ROOM_CACHE_TTL_SECONDS + 1
+
+    assert manager.cached_document("room_y") is None
+
+@pytest.mark.asyncio
+async def test_known_room_keeps_document_until_evicted(manager, mock_websocket_factory, mocker):
+    """Test an empty room's document survives until its cache entry expires."""
+    mock_time = mocker.patch("backend.app.core.ws_manager.time.monotonic", return_value=100.0)
+    room_id = "room_z"
+    ws = mock_websocket_factory("ws1")
+    await manager.connect(ws, room_id)
+    manager.remember_room(room_id)
+    manager.open_document(room_id, "code")
+
+    manager.disconnect(ws, room_id)
+    manager.evict_expired_rooms()
+    assert manager.cached_document(room_id) == "code"
+
+    mock_time.return_value = 100.0 + ROOM_CACHE_TTL_SECONDS + 1
+    manager.evict_expired_rooms()
+    assert room_id not in manager.pending
+    assert room_id not in manager.known_rooms
+
+def test_buffer_code_marks_room_dirty(manager):
+    """Test that buffered code is kept in memory and flagged for the next flush."""
+    manager.buffer_code("room_h", "first")
+    manager.buffer_code("room_h", "second")
+
+    assert manager.pending == {"room_h": "second"}
+    assert manager.dirty == {"room_h"}
+
+@pytest.mark.asyncio
+async def test_flush_writes_latest_code_once(manager, mock_websocket_factory, mocker):
+    """Test that a burst of edits is persisted with a single batched update."""
+    mock_session = mocker.MagicMock()
+    mocker.patch("backend.app.core.ws_manager.SessionLocal", return_value=mock_session)
+    mock_update = mocker.patch("backend.app.core.ws_manager.room_crud.update_room_codes")
+
+    manager.active_connections["room_i"] = {mock_websocket_factory("ws1")}
+    for code in ("a", "ab", "abc"):
+        manager.buffer_code("room_i", code)
+
+    await manager.flush()
+
+    mock_update.assert_called_once_with(mock_session, {"room_i": "abc"})
+    mock_session.close.assert_called_once()
+    assert not manager.dirty
+    # The room still has editors, so its buffer is kept
+    assert manager.pending == {"room_i": "abc"}
+
+@pytest.mark.asyncio
+async def test_flush_only_requested_rooms(manager, mocker):
+    """Test flushing a subset of rooms leaves the others dirty."""
+    mocker.patch("backend.app.core.ws_manager.SessionLocal")
+    mock_update = mocker.patch("backend.app.core.ws_manager.room_crud.update_room_codes")
+
+    manager.buffer_code("room_j", "j")
+    manager.buffer_code("room_k", "k")
+
+    await manager.flush(["room_j"])
+
+    assert mock_update.call_args[0][1] == {"room_j": "j"}
+    assert manager.dirty == {"room_k"}
+    # Nobody is connected to room_j anymore, so the buffer is released
+    assert "room_j" not in manager.pending
+
+@pytest.mark.asyncio
+async def test_flush_nothing_dirty_skips_db(manager, mocker):
+    """Test that flush does not open a session when there is nothing to write."""
+    mock_session_local = mocker.patch("backend.app.core.ws_manager.SessionLocal")
+
+    await manager.flush()
+
+    mock_session_local.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_flush_failure_keeps_rooms_dirty(manager, mocker):
+    """Test that a failed write is retried by the next flush."""
+    mock_session = mocker.MagicMock()
+    mocker.patch("backend.app.core.ws_manager.SessionLocal", return_value=mock_session)
+    mocker.patch(
+        "backend.app.core.ws_manager.room_crud.update_room_codes",
+        side_effect=Exception("DB down")
+    )
+
+    manager.buffer_code("room_l", "code")
+    await manager.flush()
+
+    assert manager.dirty == {"room_l"}
+    assert manager.pending == {"room_l": "code"}
+    mock_session.close.assert_called_once()
+
+
+# --- Tests for frames and the cross-worker broker ---
+
+@pytest.fixture
+def mock_broker():
+    """Provides a mocked RoomBroker."""
+    broker = mock.MagicMock(
+        spec=['subscribe', 'unsubscribe', 'publish', 'publish_document', 'request_document', 'close']
+    )
+    broker.publish = AsyncMock()
+    broker.publish_document = AsyncMock()
+    broker.request_document = AsyncMock()
+    return broker
+
+@pytest.mark.asyncio
+async def test_receive_frame_full_buffer(manager, mock_websocket_factory):
+    """Test a plain-text frame replaces the document and goes out as a code frame."""
+    room_id = "room_s"
+    sender = mock_websocket_factory("sender")
+    peer = mock_websocket_factory("peer")
+    for ws in (sender, peer):
+        await manager.connect(ws, room_id)
+    manager.open_document(room_id, "old")
+
+    await manager.receive_frame("new", room_id, sender)
+    await drain_writers()
+
+    assert manager.pending[room_id] == "new"
+    assert manager.dirty == {room_id}
+    assert peer.sent == [doc_sync.code_frame("new")]
+
+@pytest.mark.asyncio
+async def test_connect_and_disconnect_manage_broker_subscription(mock_broker, mock_websocket_factory):
+    """Test the room channel is subscribed by the first client and dropped after the last one."""
+    manager = ConnectionManager(mock_broker)
+    room_id = "room_t"
+    ws1 = mock_websocket_factory("ws1")
+    ws2 = mock_websocket_factory("ws2")
+
+    await manager.connect(ws1, room_id)
+    await manager.connect(ws2, room_id)
+    mock_broker.subscribe.assert_called_once_with(room_id, manager)
+
+    manager.disconnect(ws1, room_id)
+    mock_broker.unsubscribe.assert_not_called()
+    manager.disconnect(ws2, room_id)
+    mock_broker.unsubscribe.assert_called_once_with(room_id)
+
+@pytest.mark.asyncio
+async def test_receive_frame_publishes_local_frames(mock_broker, mock_websocket_factory):
+    """Test a frame from a local client is published for the other workers."""
+    manager = ConnectionManager(mock_broker)
+    room_id = "room_u"
+    sender = mock_websocket_factory("sender")
+    await manager.connect(sender, room_id)
+    manager.open_document(room_id, "")
+
+    await manager.receive_frame("print(1)", room_id, sender)
+
+    mock_broker.publish.assert_awaited_once_with(room_id, "print(1)")
+
+@pytest.mark.asyncio
+async def test_receive_frame_survives_publish_failure(mock_broker, mock_websocket_factory):
+    """Test a failing publish is logged while local peers still get the frame."""
+    manager = ConnectionManager(mock_broker)
+    mock_broker.publish.side_effect = ConnectionError("Redis is down")
+    room_id = "room_ua"
+    sender = mock_websocket_factory("sender")
+    peer = mock_websocket_factory("peer")
+    for ws in (sender, peer):
+        await manager.connect(ws, room_id)
+    manager.open_document(room_id, "")
+
+    await manager.receive_frame("print(1)", room_id, sender)
+    await drain_writers()
+
+    assert peer.sent == [doc_sync.code_frame("print(1)")]
+    assert manager.pending[room_id] == "print(1)"
+
+@pytest.mark.asyncio
+async def test_receive_frame_from_other_worker(mock_broker, mock_websocket_factory):
+    """Test a relayed frame reaches every local client and is neither persisted nor republished."""
+    manager = ConnectionManager(mock_broker)
+    room_id = "room_v"
+    clients = [mock_websocket_factory(f"ws{i}") for i in range(2)]
+    for ws in clients:
+        await manager.connect(ws, room_id)
+    manager.open_document(room_id, "")
+
+    await manager.receive_frame("remote edit", room_id)
+    await drain_writers()
+
+    assert manager.pending[room_id] == "remote edit"
+    assert not manager.dirty
+    mock_broker.publish.assert_not_awaited()
+    for ws in clients:
+        assert ws.sent == [doc_sync.code_frame("remote edit")]
+
+@pytest.mark.asyncio
+async def test_receive_frame_from_other_worker_for_closed_room(manager):
+    """Test a relayed frame for a room without local clients is ignored."""
+    await manager.receive_frame("late edit", "room_w")
+
+    assert "room_w" not in manager.pending
+
+@pytest.mark.asyncio
+async def test_relayed_patch_that_does_not_apply_requests_document(mock_broker, mock_websocket_factory):
+    """Test a diverged copy asks the other workers for their document instead of dropping the edit silently."""
+    manager = ConnectionManager(mock_broker)
+    room_id = "room_wa"
+    client = mock_websocket_factory("client")
+    await manager.connect(client, room_id)
+    manager.open_document(room_id, "abc")
+
+    dmp = diff_match_patch()
+    frame = json.dumps({"patch": dmp.patch_toText(dmp.patch_make("something else entirely", "x"))})
+    await manager.receive_frame(frame, room_id)
+
+    # The local copy takes part in picking the room's document
+    mock_broker.request_document.assert_awaited_once_with(room_id, "abc")
+    assert manager.pending[room_id] == "abc"
+
+@pytest.mark.asyncio
+async def test_patch_with_stale_base_resyncs_sender(manager, mock_websocket_factory):
+    """Test a patch made against another version whose context changed is rejected, though it would apply fuzzily."""
+    room_id = "room_wd"
+    sender = mock_websocket_factory("sender")
+    peer = mock_websocket_factory("peer")
+    await manager.connect(sender, room_id)
+    await manager.connect(peer, room_id)
+    manager.open_document(room_id, "x = 1\ny = 2\n")
+
+    dmp = diff_match_patch()
+    stale = "x = 1\n"
+    frame = json.dumps({
+        "base": doc_sync.document_hash(stale),
+        "patch": dmp.patch_toText(dmp.patch_make(stale, "x = 10\n")),
+    })
+    await manager.receive_frame(frame, room_id, sender)
+    await drain_writers()
+
+    assert manager.pending[room_id] == "x = 1\ny = 2\n"
+    assert sender.sent == [doc_sync.code_frame("x = 1\ny = 2\n")]
+    assert peer.sent == []
+
+@pytest.mark.asyncio
+async def test_concurrent_patches_to_different_lines_both_survive(manager, mock_websocket_factory):
+    """Test two senders editing different lines of the same version both keep their edit."""
+    room_id = "room_wh"
+    first = mock_websocket_factory("first")
+    second = mock_websocket_factory("second")
+    await manager.connect(first, room_id)
+    await manager.connect(second, room_id)
+    document = "a = 1\n" + "pass\n" * 10 + "z = 1\n"
+    manager.open_document(room_id, document)
+
+    dmp = diff_match_patch()
+    frames = [
+        json.dumps({
+            "base": doc_sync.document_hash(document),
+            "patch": dmp.patch_toText(dmp.patch_make(document, document.replace(old, new))),
+        })
+        for old, new in (("a = 1", "a = 100"), ("z = 1", "z = 2"))
+    ]
+    # Both were made before either sender saw the other's edit
+    await manager.receive_frame(frames[0], room_id, first)
+    await manager.receive_frame(frames[1], room_id, second)
+    await drain_writers()
+
+    assert manager.pending[room_id] == "a = 100\n" + "pass\n" * 10 + "z = 2\n"
+    # Nobody was resynced, each got the other's patch
+    assert first.sent == [frames[1]]
+    assert second.sent == [frames[0]]
+
+@pytest.mark.asyncio
+async def test_patch_with_matching_base_is_applied(manager, mock_websocket_factory):
+    """Test a patch made against the room's document is applied and relayed unchanged."""
+    room_id = "room_we"
+    sender = mock_websocket_factory("sender")
+    peer = mock_websocket_factory("peer")
+    await manager.connect(sender, room_id)
+    await manager.connect(peer, room_id)
+    manager.open_document(room_id, "x = 1\n")
+
+    dmp = diff_match_patch()
+    frame = json.dumps({
+        "base": doc_sync.document_hash("x = 1\n"),
+        "patch": dmp.patch_toText(dmp.patch_make("x = 1\n", "x = 10\n")),
+    })
+    await manager.receive_frame(frame, room_id, sender)
+    await drain_writers()
+
+    assert manager.pending[room_id] == "x = 10\n"
+    assert peer.sent == [frame]
+
+@pytest.mark.asyncio
+async def test_relayed_patch_with_stale_base_requests_document(mock_broker, mock_websocket_factory):
+    """Test another worker's patch against a different version of the document triggers a resync."""
+    manager = ConnectionManager(mock_broker)
+    room_id = "room_wf"
+    await manager.connect(mock_websocket_factory("client"), room_id)
+    manager.open_document(room_id, "x = 1\ny = 2\n")
+
+    dmp = diff_match_patch()
+    frame = json.dumps({
+        "base": doc_sync.document_hash("x = 1\n"),
+        "patch": dmp.patch_toText(dmp.patch_make("x = 1\n", "x = 10\n")),
+    })
+    await manager.receive_frame(frame, room_id)
+
+    mock_broker.request_document.assert_awaited_once_with(room_id, "x = 1\ny = 2\n")
+    assert manager.pending[room_id] == "x = 1\ny = 2\n"
+
+@pytest.mark.asyncio
+async def test_receive_document_resyncs_local_clients(mock_broker, mock_websocket_factory):
+    """Test the document picked for the room replaces the local copy, is persisted and sent to every local client."""
+    manager = ConnectionManager(mock_broker)
+    room_id = "room_wb"
+    clients = [mock_websocket_factory(f"ws{i}") for i in range(2)]
+    for ws in clients:
+        await manager.connect(ws, room_id)
+    manager.open_document(room_id, "stale")
+
+    await manager.receive_document("fresh", room_id)
+    await drain_writers()
+
+    assert manager.pending[room_id] == "fresh"
+    assert manager.dirty == {room_id}
+    for ws in clients:
+        assert ws.sent == [doc_sync.code_frame("fresh")]
+
+@pytest.mark.asyncio
+async def test_receive_document_for_closed_room(manager):
+    """Test a document for a room without local clients is ignored."""
+    await manager.receive_document("fresh", "room_wc")
+
+    assert "room_wc" not in manager.pending
+
+class FakeBus:
+    """In-memory Redis shared by several brokers; every subscriber gets each message in publish order."""
+
+    def __init__(self):
+        self.subscribers = []
+
+    async def publish(self, channel, payload):
+        for pubsub in self.subscribers:
+            if channel in pubsub.channels:
+                pubsub.queue.put_nowait({"type": "message", "data": payload})
+
+    def pubsub(self):
+        return FakeBusPubSub(self)
+
+    async def aclose(self):
+        pass
+
+class FakeBusPubSub:
+    def __init__(self, bus):
+        self.bus = bus
+        self.channels = set()
+        self.queue = asyncio.Queue()
+
+    async def subscribe(self, channel):
+        self.channels.add(channel)
+        self.bus.subscribers.append(self)
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+    async def aclose(self):
+        if self in self.bus.subscribers:
+            self.bus.subscribers.remove(self)
+
+@pytest.mark.asyncio
+async def test_workers_diverging_at_once_converge_on_one_copy(mock_websocket_factory, mocker, monkeypatch):
+    """Test two workers requesting the document at the same time end up with the same, persisted copy."""
+    monkeypatch.setattr(broker_module, "CATCH_UP_SECONDS", 0)
+    mocker.patch.object(broker_module.redis_asyncio, "from_url", return_value=FakeBus())
+    room_id = "room_wg"
+    workers, clients = [], []
+    for worker_id in ("1", "2"):
+        broker = RoomBroker("redis://localhost:6379/0")
+        broker.worker_id = worker_id
+        worker = ConnectionManager(broker)
+        client = mock_websocket_factory(f"client{worker_id}")
+        await worker.connect(client, room_id)
+        worker.open_document(room_id, "x = 1\n")
+        workers.append(worker)
+        clients.append(client)
+    await drain_writers()
+
+    # Each copy took a different edit, then both get a patch that applies to neither
+    workers[0].buffer_code(room_id, "left = 1\n")
+    workers[1].buffer_code(room_id, "right = 1\n")
+    dmp = diff_match_patch()
+    frame = json.dumps({"patch": dmp.patch_toText(dmp.patch_make("something else entirely", "x"))})
+    await asyncio.gather(*(worker.receive_frame(frame, room_id) for worker in workers))
+    await drain_writers()
+
+    # The lower worker ID's copy wins on both workers and is persisted by both
+    assert [worker.pending[room_id] for worker in workers] == ["left = 1\n", "left = 1\n"]
+    assert all(room_id in worker.dirty for worker in workers)
+    assert clients[1].sent[-1] == doc_sync.code_frame("left = 1\n")
+
+    for worker in workers:
+        await worker.broker.close()
+
+def test_current_document_returns_local_copy(manager):
+    """Test a document request is answered with this worker's copy, if it has one."""
+    manager.open_document("room_wd", "mine")
+
+    assert manager.current_document("room_wd") == "mine"
+    assert manager.current_document("room_we") is None
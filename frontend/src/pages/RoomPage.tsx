@@ -1,10 +1,39 @@
 import React, { useState, useEffect, useCallback, useRef } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
+import { diff_match_patch } from 'diff-match-patch';
 import { ApiService } from '../api/ApiService';
 // Assuming you have a CodeEditor component
 // import CodeEditor from '../components/CodeEditor'; 
 
 const language = 'python'; // Hardcoded language for the backend mock
+const dmp = new diff_match_patch();
+
+// CRC-32 of the UTF-8 document, matching the server's doc_sync.document_hash
+const CRC_TABLE = Array.from({ length: 256 }, (_, n) => {
+  let c = n;
+  for (let k = 0; k < 8; k++) {
+    c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+  }
+  return c >>> 0;
+});
+const encoder = new TextEncoder();
+
+const documentHash = (code: string): number => {
+  let crc = 0xffffffff;
+  for (const byte of encoder.encode(code)) {
+    crc = CRC_TABLE[(crc ^ byte) & 0xff] ^ (crc >>> 8);
+  }
+  return (crc ^ 0xffffffff) >>> 0;
+};
+
+// Large server frames arrive as binary zlib data; small ones as plain text
+const decodeFrame = async (data: string | ArrayBuffer): Promise<string> => {
+  if (typeof data === 'string') {
+    return data;
+  }
+  const inflated = new Blob([data]).stream().pipeThrough(new DecompressionStream('deflate'));
+  return new Response(inflated).text();
+};
 
 interface RoomParams {
   roomId: string;
@@ -15,6 +44,8 @@ const RoomPage: React.FC = () => {
   const navigate = useNavigate();
   
   const wsRef = useRef<WebSocket | null>(null);
+  // Last document state shared with the room; patches are made and applied against it
+  const sharedCodeRef = useRef<string>('');
   const [code, setCode] = useState<string>('');
   const [suggestion, setSuggestion] = useState<string>('');
   const [status, setStatus] = useState<'connecting' | 'connected' | 'error' | 'loading'>('loading');
@@ -36,9 +67,25 @@ const RoomPage: React.FC = () => {
         console.log(`WebSocket connected to room: ${roomId}`);
       };
 
+      ws.binaryType = 'arraybuffer';
+      // Decoding binary frames is async; chain them so frames are applied in arrival order
+      let received = Promise.resolve();
+
       ws.onmessage = (event) => {
-        // Received new code from a peer or initial state from server
-        setCode(event.data);
+        received = received.then(async () => {
+          // Server frames are either the full document (initial state / resync) or a peer's patch
+          const frame = JSON.parse(await decodeFrame(event.data));
+          if (typeof frame.code === 'string') {
+            sharedCodeRef.current = frame.code;
+          } else if (typeof frame.patch === 'string') {
+            const [patched] = dmp.patch_apply(dmp.patch_fromText(frame.patch), sharedCodeRef.current);
+            sharedCodeRef.current = patched;
+          }
+          setCode(sharedCodeRef.current);
+        }).catch((error) => {
+          // Keep the chain resolved, otherwise one bad frame would stop every later one
+          console.error('Failed to apply WebSocket frame:', error);
+        });
       };
 
       ws.onclose = () => {
@@ -66,9 +113,13 @@ const RoomPage: React.FC = () => {
   const handleCodeChange = (newCode: string, cursorPosition: number) => {
     setCode(newCode);
 
-    // a) Broadcast to peers (send full content)
+    // a) Broadcast to peers (send only the diff against the shared state)
+    //    base lets the server detect a patch made against a stale document and resync us
     if (wsRef.current?.readyState === WebSocket.OPEN) {
-      wsRef.current.send(newCode);
+      const base = documentHash(sharedCodeRef.current);
+      const patch = dmp.patch_toText(dmp.patch_make(sharedCodeRef.current, newCode));
+      sharedCodeRef.current = newCode;
+      wsRef.current.send(JSON.stringify({ base, patch }));
     }
 
     // b) Trigger mock autocomplete (simplified debounce logic)